@@ -0,0 +1,212 @@
+"""
+DATE: 2026/10/18
+FUNC: compute the FRAGMA cleavage profile of CpG sites from cfDNA fragment coordinates in one sweep,
+      replacing the bedtools coverage / 01.pl / 02.R / 03.R chain of data_process.sh
+INPUT FORMAT: CpG.bed: chr  start  end  sequence  metDens  label (2-base CpG sites)
+              Seq.bed: chr  start  end (fragments, grouped by chromosome), or the --binary output of extract_read_positions.py
+OUTPUT: fragma_all.txt, fragma.txt (QC filtered) and, with --interest, fragma_interest.txt, same format as 02.R/03.R
+"""
+
+from argparse import ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter
+
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+PREPROCESSING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'preprocessing')
+
+FLANK = 5
+WINDOW = 12    # upstream 5nt + CG + downstream 5nt
+FEATURES = 11
+CPG_BLOCK = 1000000
+READ_CHUNK = 5000000
+
+HEADER = ['chr', 'p1', 'p2', 'Sequence', 'MetDens', 'Label'] + ['W_%d' % i for i in range(1, FEATURES+1)] \
+    + ['C_%d' % i for i in range(1, FEATURES+1)]
+
+
+# read the CpG sites, sorted like `sort -k1,1 -k2,2n` (byte order of chromosome names)
+def read_cpgs(cpg_file):
+
+    cpgs = pd.read_csv(cpg_file, sep='\t', header=None, usecols=[0, 1, 2, 3, 4, 5],
+                       names=['chr', 'p1', 'p2', 'Sequence', 'MetDens', 'Label'],
+                       dtype={'chr': str, 'p1': np.int64, 'p2': np.int64, 'Sequence': str, 'MetDens': np.float64, 'Label': str},
+                       keep_default_na=False, float_precision='round_trip')
+    if ((cpgs['p2'] - cpgs['p1']) != WINDOW - 2*FLANK).any():
+        raise ValueError('CpG.bed should contain 2-base CpG sites')
+    order = np.lexsort((cpgs['p1'].to_numpy(), cpgs['chr'].to_numpy().astype(bytes)))
+    return cpgs.iloc[order].reset_index(drop=True)
+
+
+# yield (chromosome, starts, ends) for each chromosome of a fragment file grouped by chromosome
+def iter_fragments(seq_file):
+
+    def chunks():
+        with open(seq_file, 'rb') as fr:
+            is_binary = fr.read(2) == b'\x1f\x8b'
+        if is_binary:
+            sys.path.append(PREPROCESSING_PATH)
+            from extract_read_positions import read_positions_binary
+            for reference_names, records in read_positions_binary(seq_file, READ_CHUNK):
+                records = records[records['end'] >= 0]
+                names = np.asarray(reference_names, dtype=object)[records['chrom']]
+                yield names, records['start'], records['end']
+        else:
+            for chunk in pd.read_csv(seq_file, sep='\t', header=None, usecols=[0, 1, 2], chunksize=READ_CHUNK,
+                                     dtype={0: str, 1: np.int64, 2: np.int64}):
+                yield chunk[0].to_numpy(dtype=object), chunk[1].to_numpy(), chunk[2].to_numpy()
+
+    done = set()
+    current = None
+    starts = []
+    ends = []
+    for names, chunk_starts, chunk_ends in chunks():
+        if len(names) == 0:
+            continue
+        edges = np.concatenate(([0], np.flatnonzero(names[1:] != names[:-1]) + 1, [len(names)]))
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            if names[lo] != current:
+                if current is not None:
+                    yield current, np.concatenate(starts), np.concatenate(ends)
+                    done.add(current)
+                if names[lo] in done:
+                    raise ValueError('fragments should be grouped by chromosome (sort -k1,1 -k2,2n)')
+                current = names[lo]
+                starts = []
+                ends = []
+            starts.append(chunk_starts[lo:hi])
+            ends.append(chunk_ends[lo:hi])
+    if current is not None:
+        yield current, np.concatenate(starts), np.concatenate(ends)
+
+
+# per-base fragment coverage and W/C end counts over the 12bp windows starting at window_starts
+# cov: fragments covering the base, W: fragments starting at the base, C: fragments ending at the base
+def count_window(window_starts, sorted_starts, sorted_ends, sorted_last):
+
+    bases = window_starts[:, None] + np.arange(WINDOW)
+    started = np.searchsorted(sorted_starts, bases, side='right')
+    cov = started - np.searchsorted(sorted_ends, bases, side='right')
+    edge_w = started - np.searchsorted(sorted_starts, bases, side='left')
+    edge_c = np.searchsorted(sorted_last, bases, side='right') - np.searchsorted(sorted_last, bases, side='left')
+    return cov, edge_w, edge_c
+
+
+def format_fixed(values):
+    text = np.char.mod('%.9f', values)
+    text[np.isnan(values)] = 'NaN'
+    return text
+
+
+def format_general(value):
+    return 'NaN' if np.isnan(value) else '%.15g' % value
+
+
+# write the profile of one chromosome block, unpadded, with a leading QC flag column
+# returns the widest formatted value of each feature column
+def write_block(fw, cpgs, cov, edge_w, edge_c, interest_sums, interest):
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clvR_W = edge_w[:, :FEATURES] * 100 / cov[:, :FEATURES]
+        clvR_C = edge_c[:, :WINDOW-FEATURES-1:-1] * 100 / cov[:, :WINDOW-FEATURES-1:-1]
+    ratios = format_fixed(np.hstack((clvR_W, clvR_C)))
+
+    qcW = edge_w[:, 4] + edge_w[:, 5]
+    qcC = edge_c[:, 6] + edge_c[:, 7]
+    qc = (qcW > 1) & (qcC > 1) & (qcW + qcC > 10)
+
+    if interest is not None:
+        selected = (cpgs['Label'] == interest).to_numpy()
+        interest_sums[0] += (edge_w[selected, :FEATURES] + edge_c[selected, :WINDOW-FEATURES-1:-1]).sum(axis=0)
+        interest_sums[1] += (cov[selected, :WINDOW-FEATURES-1:-1] + cov[selected, :FEATURES]).sum(axis=0)
+
+    fixed = zip(qc.tolist(), cpgs['chr'].tolist(), (cpgs['p1'] - FLANK).tolist(), (cpgs['p2'] + FLANK).tolist(),
+                cpgs['Sequence'].tolist(), [format_general(x) for x in cpgs['MetDens'].tolist()], cpgs['Label'].tolist())
+    lines = []
+    for (passed, chrom, p1, p2, sequence, met_dens, label), row in zip(fixed, ratios.tolist()):
+        lines.append('%d\t%s\t%d\t%d\t%s\t%s\t%s\t%s\n' % (passed, chrom, p1, p2, sequence, met_dens, label, '\t'.join(row)))
+    fw.write(''.join(lines))
+
+    return np.char.str_len(ratios).max(axis=0) if len(ratios) else np.zeros(2*FEATURES, dtype=int)
+
+
+def profile_chromosome(fw, cpgs, starts, ends, interest_sums, interest):
+
+    sorted_starts = np.sort(starts)
+    sorted_ends = np.sort(ends)
+    sorted_last = sorted_ends - 1
+    widths = np.zeros(2*FEATURES, dtype=int)
+    for lo in range(0, len(cpgs), CPG_BLOCK):
+        block = cpgs.iloc[lo:lo+CPG_BLOCK]
+        cov, edge_w, edge_c = count_window(block['p1'].to_numpy() - FLANK, sorted_starts, sorted_ends, sorted_last)
+        widths = np.maximum(widths, write_block(fw, block, cov, edge_w, edge_c, interest_sums, interest))
+    return widths
+
+
+def cleavage_profile(cpg_file, seq_file, output_path, interest=None):
+
+    cpgs = read_cpgs(cpg_file)
+    chromosomes = list(dict.fromkeys(cpgs['chr'].tolist()))
+    rows = {chrom: cpgs[cpgs['chr'] == chrom] for chrom in chromosomes}
+
+    interest_sums = [np.zeros(FEATURES), np.zeros(FEATURES)]
+    widths = np.zeros(2*FEATURES, dtype=int)
+    empty = np.zeros(0, dtype=np.int64)
+
+    with tempfile.TemporaryDirectory(dir=output_path, prefix='.clvR_') as part_dir:
+        part_files = {chrom: os.path.join(part_dir, 'part_%05d.txt' % index) for index, chrom in enumerate(chromosomes)}
+
+        # fragments come in BAM order, CpGs in sort order, so each chromosome goes to its own part file
+        for chrom, starts, ends in iter_fragments(seq_file):
+            if chrom in rows:
+                with open(part_files[chrom], 'w') as fw:
+                    widths = np.maximum(widths, profile_chromosome(fw, rows[chrom], starts, ends, interest_sums, interest))
+        for chrom in chromosomes:
+            if not os.path.exists(part_files[chrom]):
+                with open(part_files[chrom], 'w') as fw:
+                    widths = np.maximum(widths, profile_chromosome(fw, rows[chrom], empty, empty, interest_sums, interest))
+
+        # R's format() right-aligns every feature column to its widest value, NaN included
+        header = '\t'.join(HEADER) + '\n'
+        with open(output_path+'/fragma_all.txt', 'w') as fw_all, open(output_path+'/fragma.txt', 'w') as fw_qc:
+            fw_all.write(header)
+            fw_qc.write(header)
+            for chrom in chromosomes:
+                with open(part_files[chrom], 'r') as fr:
+                    for line in fr:
+                        passed, line = line[0] == '1', line[2:]
+                        fields = line.rstrip('\n').split('\t')
+                        fields[6:] = [value.rjust(width) for value, width in zip(fields[6:], widths)]
+                        line = '\t'.join(fields) + '\n'
+                        fw_all.write(line)
+                        if passed:
+                            fw_qc.write(line)
+
+    if interest is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proportion = interest_sums[0] * 100 / interest_sums[1]
+        with open(output_path+'/fragma_interest.txt', 'w') as fw:
+            fw.write('Label\t' + '\t'.join('Cleavage_proportion_%d' % i for i in range(1, FEATURES+1)) + '\n')
+            fw.write(interest + '\t' + '\t'.join(format_general(x) for x in proportion) + '\n')
+
+
+def argparser():
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter, add_help=True)
+    parser.add_argument('cpg_file', type=str)
+    parser.add_argument('seq_file', type=str)
+    parser.add_argument('output_path', type=str)
+    parser.add_argument('--interest', default=None, type=str)
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+
+    args = argparser()
+    cleavage_profile(args.cpg_file, args.seq_file, args.output_path, args.interest)
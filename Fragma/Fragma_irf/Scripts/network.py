@@ -10,11 +10,24 @@ from torch import nn
 import torch
 import sys
 
+FEATURE_LENGTH = 11    # positions of the (8, 11) FRAGMA feature matrix
+
+
+# flattened size after the two convolutions (no padding, stride 1), i.e. linear1_in
+def linear1_in_features(conv1_kernel_size, conv2_out_channels, conv2_kernel_size, length=FEATURE_LENGTH):
+
+    return (length - conv1_kernel_size + 1 - conv2_kernel_size + 1) * conv2_out_channels
+
+
 class CNN(nn.Module):
 
+    # linear1_in=None derives it from the kernel sizes with linear1_in_features
     def __init__(self, conv1_out_channels, conv1_kernel_size, conv2_out_channels, conv2_kernel_size, linear1_in, linear2_in):
         super(CNN, self).__init__()
 
+        if linear1_in is None:
+            linear1_in = linear1_in_features(conv1_kernel_size, conv2_out_channels, conv2_kernel_size)
+
         self.conv1 = nn.Sequential(
             nn.Conv1d(in_channels=8, out_channels=conv1_out_channels, kernel_size=conv1_kernel_size, stride=1),
             nn.BatchNorm1d(conv1_out_channels),
@@ -54,3 +67,26 @@ class CNN(nn.Module):
             num_features *= s
             
         return num_features
+
+
+# rebuild the CNN that a saved state_dict (e.g. best_model.pt) belongs to, from its weight shapes
+def cnn_from_state_dict(state_dict):
+
+    conv1_out_channels, _, conv1_kernel_size = state_dict['conv1.0.weight'].shape
+    conv2_out_channels, _, conv2_kernel_size = state_dict['conv2.0.weight'].shape
+    linear2_in, linear1_in = state_dict['linear1.0.weight'].shape
+    net = CNN(conv1_out_channels, conv1_kernel_size, conv2_out_channels, conv2_kernel_size, linear1_in, linear2_in)
+    net.load_state_dict(state_dict)
+
+    return net
+
+
+# fold each BatchNorm into the convolution before it, for inference only (the net must be in eval mode)
+def fuse_batchnorm(net):
+
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+    for name in ['conv1', 'conv2']:
+        conv, bn, relu = getattr(net, name)
+        setattr(net, name, nn.Sequential(fuse_conv_bn_eval(conv, bn), relu))
+
+    return net
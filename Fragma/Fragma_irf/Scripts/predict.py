@@ -0,0 +1,147 @@
+"""
+DATE: 2026/10/18
+FUNC: score every CpG of a FRAGMA feature table with a trained CNN (best_model.pt of training_testing.py)
+INPUT FORMAT: chr     p1      p2      context metDens label   W_1 ... W_11   C_1 ... C_11 (fragma_all.txt / fragma.txt, label may be anything)
+OUTPUT: chr  p1  p2  label  output  predict, as parquet (.parquet) or gzip-compressed tab-separated text
+        CpGs with a NaN ratio (no coverage at a window position, fragma_all.txt) are not scored:
+        output nan, predict null (NA in text)
+"""
+
+from argparse import ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter
+
+import gzip
+import numpy as np
+
+import torch
+
+import network
+from training_testing import load_context_index, read_feature_chunks, encode_features, FEATURE_LENGTH
+
+
+CHUNK_SIZE = 2000000
+BATCH_SIZE = 65536
+
+
+# load the trained CNN for inference, optionally with BatchNorm folded into the convolutions and compiled
+def load_model(model_file, dev, fuse_bn=False, compile_mode=None):
+
+    net = network.cnn_from_state_dict(torch.load(model_file, map_location='cpu'))
+    net.eval()
+    if fuse_bn:
+        net = network.fuse_batchnorm(net)
+    net = net.to(dev)
+
+    if compile_mode == 'script':
+        net = torch.jit.script(net)
+    elif compile_mode == 'compile':
+        net = torch.compile(net)
+
+    return net
+
+
+# outputs of net for (N, 8, 11) features, batch by batch
+def score(net, features, dev, batch_size=BATCH_SIZE):
+
+    outputs = np.empty(len(features), dtype=np.float32)
+    with torch.inference_mode():
+        for lo in range(0, len(features), batch_size):
+            batch_data = torch.from_numpy(features[lo:lo+batch_size]).to(dev)
+            outputs[lo:lo+batch_size] = net(batch_data).reshape(-1).cpu().numpy()
+
+    return outputs
+
+
+# writes the predictions chunk by chunk: one parquet row group, or one block of text lines, per chunk
+class PredictionWriter:
+
+    def __init__(self, output_file):
+        self.parquet = output_file.endswith('.parquet')
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.pa = pa
+            self.schema = pa.schema([('chr', pa.dictionary(pa.int32(), pa.string())), ('p1', pa.int32()), ('p2', pa.int32()),
+                                     ('label', pa.int8()), ('output', pa.float32()), ('predict', pa.bool_())])
+            self.writer = pq.ParquetWriter(output_file, self.schema, compression='zstd')
+        else:
+            self.writer = gzip.open(output_file, 'wt')
+            self.writer.write('chr\t'+'p1\t'+'p2\t'+'label\t'+'output\t'+'predict\n')
+
+    # output is nan for the CpGs that were not scored, their predict is written as null
+    def write(self, chrom, p1, label, output):
+        scored = ~np.isnan(output)
+        predict = output >= 0.5
+        if self.parquet:
+            pa = self.pa
+            chrom = pa.array(chrom, type=pa.string()).dictionary_encode()
+            table = pa.Table.from_arrays([chrom, pa.array(p1), pa.array(p1 + 12), pa.array(label), pa.array(output),
+                                          pa.array(predict, mask=~scored)], schema=self.schema)
+            self.writer.write_table(table)
+        else:
+            lines = []
+            for chr, start, lab, out, pred, ok in zip(chrom, p1.tolist(), label.tolist(), output.tolist(), predict.tolist(),
+                                                      scored.tolist()):
+                pred = str(pred) if ok else 'NA'
+                lines.append(chr+'\t'+str(start)+'\t'+str(start+12)+'\t'+str(lab)+'\t'+str(out)+'\t'+pred+'\n')
+            self.writer.write(''.join(lines))
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(args):
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    dev = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    net = load_model(args.model, dev, args.fuse_bn, args.compile)
+    context_index = load_context_index(args.context_index) if args.context_index else None
+
+    # the table is read, encoded and scored one chunk at a time, so memory does not grow with the genome
+    # CpGs with a non-finite ratio are left out of scoring and written with a nan output and a null prediction
+    num_cpg = 0
+    num_unscored = 0
+    with PredictionWriter(args.output_file) as writer:
+        for chunk in read_feature_chunks(args.data_file, context_index, args.chunk_size):
+            scorable = np.isfinite(chunk['ratio']).all(axis=1)
+            features = encode_features(chunk['w_seq'][scorable], chunk['c_seq'][scorable],
+                                       chunk['ratio'][scorable, :FEATURE_LENGTH], chunk['ratio'][scorable, FEATURE_LENGTH:])
+            outputs = np.full(len(scorable), np.nan, dtype=np.float32)
+            outputs[scorable] = score(net, features, dev, args.batch_size)
+            writer.write(chunk['chrom'], chunk['p1'], chunk['label'], outputs)
+            num_cpg += len(outputs)
+            num_unscored += int((~scorable).sum())
+            print('scored {} CpGs, {} without coverage at every window position left unscored'.format(num_cpg - num_unscored,
+                                                                                                      num_unscored))
+
+
+def argparser():
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter, add_help=True)
+    parser.add_argument('--data_file', default=None, type=str)
+    parser.add_argument('--model', default=None, type=str, help='best_model.pt written by training_testing.py')
+    parser.add_argument('--output_file', default=None, type=str, help='.parquet, or any other name for gzip text')
+    parser.add_argument('--context_index', default=None, type=str)
+    parser.add_argument('--chunk_size', default=CHUNK_SIZE, type=int, help='CpGs read and encoded at a time')
+    parser.add_argument('--batch_size', default=BATCH_SIZE, type=int, help='CpGs per forward pass')
+    parser.add_argument('--fuse_bn', action='store_true', help='fold BatchNorm into the convolutions')
+    parser.add_argument('--compile', default=None, choices=['script', 'compile'], help='TorchScript or torch.compile the model')
+    parser.add_argument('--num_threads', default=None, type=int, help='torch CPU threads')
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+
+    args = argparser()
+    main(args)
@@ -0,0 +1,207 @@
+"""
+DATE: 2026/10/18
+FUNC: hyperparameter sweep of the FRAGMA CNN, a grid or random search with configurations trained in parallel processes
+INPUT FORMAT: data_file as training_testing.py; space: JSON object of parameter -> list of values, e.g.
+              {"conv1_kernel_size": [3, 4, 5], "conv2_out_channels": [32, 64], "lr": [0.001, 0.0003]}
+              parameters left out keep the values of training_testing.py; linear1_in follows from the kernel sizes
+OUTPUT: leaderboard.txt (one row per configuration, highest validation auc first) and log.txt in output_path
+"""
+
+from argparse import ArgumentParser
+from argparse import ArgumentDefaultsHelpFormatter
+
+import sys
+import json
+import time
+import random
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+import torch.multiprocessing
+from torch import nn
+
+import network
+from training_testing import (load_context_index, data_summary, split_ids, load_features, cache_source, build_dataset,
+                              build_dataloader, TorchDataset, run_epoch, auc_score, Logger)
+
+
+DEFAULT_SPACE = {'conv1_out_channels': [64], 'conv1_kernel_size': [4], 'conv2_out_channels': [64], 'conv2_kernel_size': [4],
+                 'linear2_in': [10], 'lr': [0.001], 'batch_size': [64]}
+
+LEADERBOARD_COLUMNS = list(DEFAULT_SPACE) + ['linear1_in', 'epochs', 'best_epoch', 'valid_loss', 'valid_auc', 'test_auc',
+                                             'wall_time']
+
+
+# the search space of a JSON file, on top of DEFAULT_SPACE
+def load_space(space_file=None):
+
+    space = dict(DEFAULT_SPACE)
+    if space_file is not None:
+        with open(space_file) as fr:
+            values = json.load(fr)
+        unknown = set(values) - set(DEFAULT_SPACE)
+        if unknown:
+            raise ValueError('unknown parameters in {}: {}'.format(space_file, ', '.join(sorted(unknown))))
+        space.update({name: value if isinstance(value, list) else [value] for name, value in values.items()})
+
+    return space
+
+
+# every combination of the space
+def grid_configs(space):
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*space.values())]
+
+
+# num_configs different combinations drawn at random
+def random_configs(space, num_configs, seed):
+
+    configs = grid_configs(space)
+    random.Random(seed).shuffle(configs)
+    return configs[:num_configs]
+
+
+# the training, validation and testing sets of the parent process, shared by every worker
+_shared = None
+
+
+def _init_worker(shared, num_threads):
+    global _shared
+    _shared = shared
+    torch.set_num_threads(num_threads)
+
+
+# train one configuration like training_testing.py and test the model of the lowest validation loss
+# a configuration without a finite validation loss in any epoch (a diverged run) failed: its aucs are nan
+def train_config(index, config, epochs, patience, seed):
+
+    start_time = time.time()
+    torch.manual_seed(seed + index)
+    np.random.seed(seed + index)
+    dev = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    loaders = {}
+    for split, (features, labels, ids) in _shared.items():
+        dataset = TorchDataset(features.numpy(), labels.numpy(), ids.numpy())
+        loaders[split] = build_dataloader(dataset, config['batch_size'], shuffle=split == 'train')
+
+    net = network.CNN(config['conv1_out_channels'], config['conv1_kernel_size'], config['conv2_out_channels'],
+                      config['conv2_kernel_size'], None, config['linear2_in']).to(dev)
+    loss_fn = nn.BCELoss()
+    optimizer = torch.optim.Adam(net.parameters(), config['lr'])
+
+    best = {'valid_loss': float('inf'), 'valid_auc': float('nan'), 'best_epoch': 0, 'model': None}
+    for epoch in range(epochs):
+        net.train()
+        run_epoch(net, loaders['train'], loss_fn, dev, optimizer)
+        net.eval()
+        valid_loss, _, validOutputList, validLabelList, _ = run_epoch(net, loaders['valid'], loss_fn, dev)
+
+        if valid_loss < best['valid_loss']:
+            best = {'valid_loss': valid_loss, 'valid_auc': auc_score(validLabelList, validOutputList), 'best_epoch': epoch + 1,
+                    'model': {name: value.clone() for name, value in net.state_dict().items()}}
+        elif patience is not None and epoch + 1 - best['best_epoch'] >= patience:
+            break
+
+    model = best.pop('model')
+    test_auc = float('nan')
+    if model is not None:
+        net.load_state_dict(model)
+        net.eval()
+        _, _, testOutputList, testLabelList, _ = run_epoch(net, loaders['test'], loss_fn, dev)
+        test_auc = auc_score(testLabelList, testOutputList)
+
+    result = dict(config)
+    result.update(best)
+    result.update({'linear1_in': network.linear1_in_features(config['conv1_kernel_size'], config['conv2_out_channels'],
+                                                             config['conv2_kernel_size']),
+                   'epochs': epoch + 1, 'test_auc': test_auc,
+                   'wall_time': time.time() - start_time})
+    return result
+
+
+def write_leaderboard(results, leaderboard_file):
+
+    # failed configurations (nan valid_auc) last
+    results = sorted(results, key=lambda result: (np.isnan(result['valid_auc']), -result['valid_auc']))
+    lines = ['rank\t' + '\t'.join(LEADERBOARD_COLUMNS) + '\n']
+    for rank, result in enumerate(results, 1):
+        lines.append(str(rank) + '\t' + '\t'.join(str(result[column]) for column in LEADERBOARD_COLUMNS) + '\n')
+    with open(leaderboard_file, 'w') as fw:
+        fw.write(''.join(lines))
+
+
+def main(args):
+
+    output_path = args.output_path
+    sys.stdout = Logger(output_path+'/log.txt')
+
+    space = load_space(args.space)
+    configs = grid_configs(space) if args.search == 'grid' else random_configs(space, args.num_configs, args.seed)
+    valid = [network.linear1_in_features(config['conv1_kernel_size'], config['conv2_out_channels'], config['conv2_kernel_size']) > 0
+             for config in configs]
+    for config in itertools.compress(configs, [not keep for keep in valid]):
+        print('skipping {}: the kernels are longer than the feature matrix'.format(config))
+    configs = list(itertools.compress(configs, valid))
+    print('{} configurations, {} workers with {} threads each'.format(len(configs), args.workers, args.threads))
+
+    # ============ data processing =======================
+    # the data is read, split and encoded once; every configuration trains on the same split
+    print('data processing ...')
+    np.random.seed(args.seed)
+    context_index = load_context_index(args.context_index) if args.context_index else None
+    cg_data, M_num, U_num, M_id, U_id = data_summary(args.data_file, context_index)
+    train_id, valid_id, test_id = split_ids(M_id, U_id)
+    features = load_features(cg_data, args.feature_cache, cache_source(args.data_file, args.context_index))
+
+    shared = {}
+    for split, id_list in [('train', train_id), ('valid', valid_id), ('test', test_id)]:
+        dataset = build_dataset(features, cg_data, id_list)
+        shared[split] = tuple(torch.from_numpy(array).share_memory_() for array in (dataset.features, dataset.labels, dataset.id_list))
+    del features, cg_data
+
+    # ============ sweep =======================
+    print('sweeping ...')
+    results = []
+    context = torch.multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=_init_worker,
+                             initargs=(shared, args.threads)) as executor:
+        futures = [executor.submit(train_config, index, config, args.epochs, args.patience, args.seed)
+                   for index, config in enumerate(configs)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print('{} | valid_auc: {} | test_auc: {} | {:.1f}s'.format(
+                {name: result[name] for name in space}, result['valid_auc'], result['test_auc'], result['wall_time']))
+            write_leaderboard(results, output_path+'/leaderboard.txt')
+
+    print('sweep finish =====================')
+
+
+def argparser():
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter, add_help=True)
+    parser.add_argument('--data_file', default=None, type=str)
+    parser.add_argument('--output_path', default=None, type=str)
+    parser.add_argument('--space', default=None, type=str, help='JSON file of parameter -> list of values')
+    parser.add_argument('--search', default='grid', choices=['grid', 'random'])
+    parser.add_argument('--num_configs', default=20, type=int, help='configurations drawn by --search random')
+    parser.add_argument('--workers', default=2, type=int, help='configurations trained at the same time')
+    parser.add_argument('--threads', default=1, type=int, help='torch CPU threads per worker')
+    parser.add_argument('--epochs', default=20, type=int)
+    parser.add_argument('--patience', default=None, type=int, help='early stopping patience in epochs, off by default')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--context_index', default=None, type=str)
+    parser.add_argument('--feature_cache', default=None, type=str, help='.npy file of the encoded features, reused across runs')
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+
+    args = argparser()
+    main(args)
@@ -8,117 +8,483 @@ AUTH  : Rong QIAO
 from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter
 
+import os
 import sys
+import json
+import random
+from collections import OrderedDict
 import numpy as np
+import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import roc_auc_score
 
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler, get_worker_info
 from torch import nn
 
 import network
 
+PREPROCESSING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'preprocessing')
 
 
-def DNA_reverse(sequence):
-    return sequence[::-1]
+# open the CpG context index built by Fragma/preprocessing/cpg_context_index.py
+def load_context_index(index_file):
+    sys.path.append(PREPROCESSING_PATH)
+    from cpg_context_index import CpGContextIndex
+    return CpGContextIndex(index_file)
 
 
-def DNA_complement(sequence):
-    trantab = str.maketrans('ACGTacgtNn','TGCAtgcaNn')
-    string = sequence.translate(trantab)
-    return string
+SEQ_MAPPING = {'A':0, 'C':1, 'G':2, 'T':3}
+LABEL_MAPPING = {'M':1, 'U':0}
+CONTEXT_LENGTH = 12
+FEATURE_LENGTH = 11
+CHUNK_SIZE = 1000000
+TRAIN_PRO = 0.7
+VALID_PRO = 0.15
+TEST_PRO = 0.15
 
 
-# summarize the cg information into dict, and get the data number for M and U group
-def data_summary(data_file):
-    
-    M_num = 0
-    U_num = 0
-    M_id = []
-    U_id = []
-    cg_dict = {}
-    with open(data_file, 'r') as fr:
-        line = fr.readline().rstrip().lstrip().split()
-        while line:
-            line = fr.readline().rstrip().lstrip().split()
-            if len(line) <= 1:
-                break
-            
-            cg_id = line[0]+':'+line[1]
-            
-            sequence = line[3]    # 12bp context
-            w_seq = sequence[0:11]
-            c_seq = DNA_complement(DNA_reverse(sequence))[0:11]
-            if 'N' in w_seq or 'N' in c_seq:
-                continue
-            
-            w_ratio = [float(x) for x in line[6:17]]     # [0.4,0.5,0.2,0.3]
-            c_ratio = [float(x) for x in line[17:28]]
-
-            label = line[5]
-
-            if label == 'M':
-                M_num += 1
-                M_id.append(cg_id)
-            elif label == 'U':
-                U_num += 1
-                U_id.append(cg_id)
-
-            cg_dict[cg_id] = {'w_seq':w_seq, 'c_seq':c_seq, 'w_ratio':w_ratio, 'c_ratio':c_ratio, 'label':label}
-    
-    return cg_dict, M_num, U_num, M_id, U_id
+# encode sequences (as an (N, length) uint8 byte matrix) into codes following SEQ_MAPPING
+def encode_sequences(seq_bytes):
+
+    lookup = np.full(256, 255, dtype=np.uint8)
+    for base, code in SEQ_MAPPING.items():
+        lookup[ord(base)] = code
+    codes = lookup[seq_bytes]
+    if (codes == 255).any():
+        raise ValueError('sequences should only contain A, C, G and T')
+
+    return codes
+
+
+# look the 12bp contexts up in the context index by CpG position (p1 is 5bp upstream of the C)
+def lookup_contexts(context_index, chrom, p1, sequences):
+
+    sequences = sequences.copy()
+    for name in np.unique(chrom):
+        rows = np.flatnonzero(chrom == name)
+        for row, context in zip(rows, context_index.fetch_contexts(name, p1[rows] + 5)):
+            if context is not None:
+                sequences[row] = context
+    return sequences
+
+
+# parse the feature table in chunks of typed column arrays, skipping contexts with N
+# with a context index, the 12bp context is looked up by CpG position instead of read from the file
+def read_feature_chunks(data_file, context_index=None, chunk_size=CHUNK_SIZE):
+
+    usecols = [0, 1, 3, 5] + list(range(6, 6 + 2*FEATURE_LENGTH))
+    dtypes = {0: str, 1: np.int64, 3: str, 5: str}
+    dtypes.update({col: np.float64 for col in usecols[4:]})
+    reader = pd.read_csv(data_file, sep=r'\s+', header=None, skiprows=1, usecols=usecols, dtype=dtypes,
+                         chunksize=chunk_size)
+
+    for chunk in reader:
+        chrom = chunk[0].to_numpy(dtype=object)
+        p1 = chunk[1].to_numpy()
+        sequences = chunk[3].to_numpy(dtype=object)
+        if context_index is not None:
+            sequences = lookup_contexts(context_index, chrom, p1, sequences)
+        if (pd.Series(sequences).str.len() != CONTEXT_LENGTH).any():
+            raise ValueError('the context column should hold {}bp sequences'.format(CONTEXT_LENGTH))
+
+        # w_seq is the first 11bp, c_seq the first 11bp of the reverse complement; skip any context with N
+        seq_bytes = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8).reshape(-1, CONTEXT_LENGTH)
+        keep = ~(seq_bytes == ord('N')).any(axis=1)
+        seq_bytes = seq_bytes[keep]
+
+        yield {'chrom': chrom[keep],
+               'p1': p1[keep].astype(np.int32),
+               'w_seq': encode_sequences(seq_bytes[:, :FEATURE_LENGTH]),
+               'c_seq': 3 - encode_sequences(seq_bytes[:, :CONTEXT_LENGTH-FEATURE_LENGTH-1:-1]),    # complement of A/C/G/T is 3 - code
+               'ratio': chunk[usecols[4:]].to_numpy(dtype=np.float32)[keep],
+               'label': chunk[5].map(LABEL_MAPPING).fillna(-1).to_numpy(dtype=np.int8)[keep]}    # -1: neither M nor U
+
+
+# load the cg information into typed column arrays, and get the row numbers for M and U group
+def data_summary(data_file, context_index=None):
+
+    chunks = list(read_feature_chunks(data_file, context_index))
+    keys = ['chrom', 'p1', 'w_seq', 'c_seq', 'ratio', 'label']
+    cg_data = {key: np.concatenate([chunk[key] for chunk in chunks]) if chunks else np.zeros(0) for key in keys}
+    M_id = np.flatnonzero(cg_data['label'] == 1)
+    U_id = np.flatnonzero(cg_data['label'] == 0)
+
+    return cg_data, len(M_id), len(U_id), M_id, U_id
 
 # INPUT: data_file name
-# OUTPUT: cg_dict: {
-#                   'chr:start':
-#                            w_seq:'ACGT'(str), c_seq:'ACGT'(str), w_ratio:[0.2](list), c_ratio[0.2](list), label:M or U
+# OUTPUT: cg_data: {
+#                   chrom: (N,) str, p1: (N,) int32, w_seq/c_seq: (N, 11) uint8 codes of SEQ_MAPPING,
+#                   ratio: (N, 22) float32 W_1..W_11 and C_1..C_11, label: (N,) int8 1 for M, 0 for U, -1 otherwise
 #                  }
+#         M_id, U_id: row numbers of the M and U sites in cg_data
 
 
+# build the feature matrices of all CpGs at once: one-hot sequence weighted by the cleavage ratio
+# INPUT: w_codes, c_codes: (N, 11) uint8; w_ratio, c_ratio: (N, 11)
+# OUTPUT: (N, 8, 11) float32, rows 0-3 are A/C/G/T of the Watson strand, rows 4-7 of the Crick strand
+def encode_features(w_codes, c_codes, w_ratio, c_ratio):
+
+    num, length = w_codes.shape
+    features = np.zeros((num, 2*len(SEQ_MAPPING), length), dtype=np.float32)
+    rows = np.arange(num)[:, None]
+    cols = np.arange(length)
+    features[rows, w_codes, cols] = w_ratio
+    features[rows, len(SEQ_MAPPING) + c_codes, cols] = c_ratio
+
+    return features
+
+
+# down sample the larger of the M and U groups, then split the rows into training, validation and testing ids
+def split_ids(M_id, U_id):
+
+    M_num, U_num = len(M_id), len(U_id)
+    if M_num > U_num:
+        total_data = U_num
+        M_new_id = np.random.choice(M_id, total_data, replace=False)
+        U_new_id = U_id
+    else:
+        total_data = M_num
+        M_new_id = M_id
+        U_new_id = np.random.choice(U_id, total_data, replace=False)
+
+    [M_train, M_test, U_train, U_test] = train_test_split(M_new_id, U_new_id, test_size=VALID_PRO+TEST_PRO, random_state=10)
+    [M_val, M_test, U_val, U_test] = train_test_split(M_test, U_test, test_size=TEST_PRO/(TEST_PRO+VALID_PRO), random_state=10)
+
+    train_id = np.concatenate((M_train, U_train))
+    valid_id = np.concatenate((M_val, U_val))
+    test_id = np.concatenate((M_test, U_test))
+
+    return train_id, valid_id, test_id
+
+
+# what a cache made from data_file depends on: the file, the context index and the feature encoding
+def cache_source(data_file, context_index=None):
+
+    def file_source(path):
+        return {'path': os.path.abspath(path), 'size': os.path.getsize(path), 'mtime': os.path.getmtime(path)}
+
+    return {'data_file': file_source(data_file), 'context_index': file_source(context_index) if context_index else None,
+            'feature_length': FEATURE_LENGTH, 'seq_mapping': SEQ_MAPPING}
+
+
+# features of every CpG in cg_data, reused from cache_file when it was made from the same source (see cache_source)
+# the source is kept in cache_file.json, written after the features so that it marks a complete cache
+def load_features(cg_data, cache_file=None, source=None):
+
+    meta_file = None if cache_file is None else cache_file + '.json'
+    if cache_file is not None and os.path.exists(cache_file) and os.path.exists(meta_file):
+        with open(meta_file) as fr:
+            cached_source = json.load(fr)
+        features = np.load(cache_file, mmap_mode='r')
+        if cached_source == source and features.shape[0] == len(cg_data['label']):
+            return features
+
+    features = encode_features(cg_data['w_seq'], cg_data['c_seq'],
+                               cg_data['ratio'][:, :FEATURE_LENGTH], cg_data['ratio'][:, FEATURE_LENGTH:])
+    if cache_file is not None:
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        with open(cache_file, 'wb') as fw:
+            np.save(fw, features)
+        with open(meta_file + '.tmp', 'w') as fw:
+            json.dump(source, fw)
+        os.replace(meta_file + '.tmp', meta_file)
+        features = np.load(cache_file, mmap_mode='r')
+
+    return features
+
 
 # define dataloader
 class TorchDataset(Dataset):
     
-    def __init__(self, cg_dict, id_list):
-        self.cg_dict = cg_dict
-        self.id_list = id_list
+    def __init__(self, features, labels, id_list):
+        self.features = features    # contiguous (N, 8, 11) float32
+        self.labels = labels
+        self.id_list = id_list      # row numbers in cg_data
     
+    # idx is one index, or a list of indices when the DataLoader uses a BatchSampler
     def __getitem__(self, idx):
-        select_id = self.id_list[idx]
-        w_seq = self.cg_dict[select_id]['w_seq']
-        c_seq = self.cg_dict[select_id]['c_seq']
-        w_ratio = self.cg_dict[select_id]['w_ratio']
-        c_ratio = self.cg_dict[select_id]['c_ratio']
-        
-        w_matrix = transfer(w_seq, w_ratio)
-        c_matrix = transfer(c_seq, c_ratio)
-        
-        matrix = np.vstack((w_matrix, c_matrix))
-        
-        label_mapping = {'M':1, 'U':0}
-        label = label_mapping[self.cg_dict[select_id]['label']]
-        
-        return matrix, label, select_id
+        if isinstance(idx, (int, np.integer)):
+            return torch.from_numpy(self.features[idx]), int(self.labels[idx]), int(self.id_list[idx])
+
+        idx = np.asarray(idx)
+        if len(idx) > 0 and (np.diff(idx) == 1).all():
+            idx = slice(idx[0], idx[-1]+1)    # consecutive batch: zero-copy view
+        return torch.from_numpy(self.features[idx]), torch.from_numpy(self.labels[idx]), torch.from_numpy(self.id_list[idx])
     
     def __len__(self):
         return len(self.id_list)
-    
 
-# build the feature matrix
-def transfer(seq, ratio_list):
-    
-    seq_mapping = {'A':0, 'C':1, 'G':2, 'T':3}
-    matrix = np.zeros((len(seq_mapping), len(seq)))
-    for index in range(len(seq)):
-        
-        row = seq_mapping[seq[index]]
-        col = index
 
-        matrix[row, col] = ratio_list[index]
+# gather the features of the id_list rows into one contiguous dataset
+def build_dataset(features, cg_data, id_list):
+
+    rows = np.asarray(id_list, dtype=np.int64)
+    labels = cg_data['label'][rows].astype(np.int64)
+
+    return TorchDataset(np.ascontiguousarray(features[rows]), labels, rows)
+
+
+# the sampler hands whole batches of indices to the dataset, so batches are sliced instead of collated
+def build_dataloader(dataset, batch_size, shuffle):
+
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset=dataset, sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False), batch_size=None)
+
+
+# ============ sharded multi-sample data =======================
+# every per-sample feature file is one shard; a shard is parsed the first time it is used and its
+# columns are cached as .npy files, so later epochs (and runs) only memory-map them
+SPLIT_SEED = 10
+MAX_SHARDS = 4
+SHARD_COLUMNS = ['w_seq', 'c_seq', 'ratio', 'label', 'p1', 'chrom']
+SPLITS = {'train': 0, 'valid': 1, 'test': 2}
+
+
+# feature files of a directory, or listed one per line in a manifest (relative to the manifest)
+def list_shards(path):
+
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if not name.startswith('.') and os.path.isfile(os.path.join(path, name)))
+
+    with open(path) as fr:
+        lines = [line.strip() for line in fr]
+    return [os.path.join(os.path.dirname(os.path.abspath(path)), line) for line in lines if line and not line.startswith('#')]
+
 
-    return matrix
+# lazily indexed shards, at most max_shards of them open at a time
+class ShardStore:
+
+    def __init__(self, shard_files, cache_dir, context_index=None, max_shards=MAX_SHARDS):
+        self.shard_files = shard_files
+        self.cache_dir = cache_dir
+        self.context_index = context_index    # path, opened in the process that parses a shard
+        self.max_shards = max_shards
+        self.loaded = OrderedDict()
+
+    # DataLoader workers start without open shards
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['loaded'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.shard_files)
+
+    def cache_prefix(self, shard):
+        return os.path.join(self.cache_dir, '{:05d}'.format(shard))
+
+    # parse one feature file into the cache, unless the cache was made from the same source (see cache_source)
+    def index(self, shard):
+
+        data_file = self.shard_files[shard]
+        source = cache_source(data_file, self.context_index)
+        meta_file = self.cache_prefix(shard) + '.json'
+        if os.path.exists(meta_file):
+            with open(meta_file) as fr:
+                if json.load(fr) == source:
+                    return
+
+        context_index = load_context_index(self.context_index) if self.context_index else None
+        cg_data = data_summary(data_file, context_index)[0]
+        cg_data['chrom'] = cg_data['chrom'].astype(str)
+        for column in SHARD_COLUMNS:
+            np.save(self.cache_prefix(shard) + '.' + column + '.npy', cg_data[column])
+        with open(meta_file + '.tmp', 'w') as fw:
+            json.dump(source, fw)
+        os.replace(meta_file + '.tmp', meta_file)    # the metadata is written last and marks a complete cache
+
+    # columns of one shard, memory-mapped, closing the least recently used shard beyond max_shards
+    def load(self, shard):
+
+        if shard in self.loaded:
+            self.loaded.move_to_end(shard)
+            return self.loaded[shard]
+
+        self.index(shard)
+        data = {column: np.load(self.cache_prefix(shard) + '.' + column + '.npy', mmap_mode='r') for column in SHARD_COLUMNS}
+        data['split'] = split_rows(shard, len(data['label']))
+        self.loaded[shard] = data
+        while len(self.loaded) > self.max_shards:
+            self.loaded.popitem(last=False)
+        return data
+
+    # chr and p1 of (shard, row) ids made by ShardedDataset
+    def describe(self, ids):
+
+        shards, rows = ids >> 32, ids & 0xFFFFFFFF
+        chrs = np.empty(len(ids), dtype=object)
+        starts = np.empty(len(ids), dtype=np.int64)
+        for shard in np.unique(shards):
+            selected = shards == shard
+            data = self.load(int(shard))
+            chrs[selected] = data['chrom'][rows[selected]]
+            starts[selected] = data['p1'][rows[selected]]
+        return chrs, starts
+
+
+# fixed train/valid/test assignment of the rows of one shard
+def split_rows(shard, num):
+
+    draw = np.random.default_rng([SPLIT_SEED, shard]).random(num)
+    return np.digitize(draw, [TRAIN_PRO, TRAIN_PRO + VALID_PRO]).astype(np.int8)
+
+
+# M and U rows of one split of a shard, down sampled to the same number and paired up
+def balanced_rows(data, split, rng):
+
+    in_split = data['split'] == SPLITS[split]
+    M_rows = np.flatnonzero(in_split & (data['label'] == 1))
+    U_rows = np.flatnonzero(in_split & (data['label'] == 0))
+    num = min(len(M_rows), len(U_rows))
+    M_rows = np.sort(rng.choice(M_rows, num, replace=False))
+    U_rows = np.sort(rng.choice(U_rows, num, replace=False))
+
+    return np.stack((M_rows, U_rows), axis=1)
+
+
+# class-balanced minibatches over all shards of one split, with a bounded number of shards in memory
+# training batches come from a random window of max_shards shards at a time; each DataLoader worker takes its own shards
+# ids are shard << 32 | row
+class ShardedDataset(IterableDataset):
+
+    def __init__(self, store, split, batch_size, shuffle):
+        self.store = store
+        self.split = split
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+
+        worker = get_worker_info()
+        shards = np.arange(len(self.store))
+        if worker is not None:
+            shards = shards[worker.id::worker.num_workers]
+        if self.shuffle:
+            # the torch generator differs between epochs and workers, and is restored on --resume
+            rng = np.random.default_rng(int(torch.randint(2**62, ()).item()))
+            shards = rng.permutation(shards)
+
+        for lo in range(0, len(shards), self.store.max_shards):
+            pairs = []
+            for shard in shards[lo:lo+self.store.max_shards]:
+                data = self.store.load(int(shard))
+                shard_rng = rng if self.shuffle else np.random.default_rng([SPLIT_SEED, int(shard)])
+                pairs.append((int(shard) << 32) | balanced_rows(data, self.split, shard_rng))
+            pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+            if self.shuffle:
+                pairs = rng.permutation(pairs)
+            keys = pairs.reshape(-1)    # M, U, M, U, ... so every batch holds both classes equally
+
+            for start in range(0, len(keys), self.batch_size):
+                yield self.batch(keys[start:start+self.batch_size])
+
+    def batch(self, ids):
+
+        shards, rows = ids >> 32, ids & 0xFFFFFFFF
+        features = np.empty((len(ids), 2*len(SEQ_MAPPING), FEATURE_LENGTH), dtype=np.float32)
+        labels = np.empty(len(ids), dtype=np.int64)
+        for shard in np.unique(shards):
+            selected = np.flatnonzero(shards == shard)
+            data = self.store.load(int(shard))
+            shard_rows = rows[selected]
+            ratio = data['ratio'][shard_rows]
+            features[selected] = encode_features(data['w_seq'][shard_rows], data['c_seq'][shard_rows],
+                                                 ratio[:, :FEATURE_LENGTH], ratio[:, FEATURE_LENGTH:])
+            labels[selected] = data['label'][shard_rows]
+        return torch.from_numpy(features), torch.from_numpy(labels), torch.from_numpy(ids)
+
+
+def build_shard_dataloader(dataset, num_workers):
+    return DataLoader(dataset=dataset, batch_size=None, num_workers=num_workers)
+
+
+# run net over every batch of dataLoader once, updating it when an optimizer is given
+# per-batch results stay on the device and are concatenated once, so the host is only synchronised at the end
+# with bf16, the forward pass runs under bfloat16 autocast and the loss is computed in float32
+# OUTPUT: loss, acc (%), and the outputs, labels and ids of the whole dataset as numpy arrays
+def run_epoch(net, dataLoader, loss_fn, dev, optimizer=None, bf16=False):
+
+    total_loss = torch.zeros((), dtype=torch.float64, device=dev)
+    correct_num = torch.zeros((), dtype=torch.int64, device=dev)
+    num = 0
+    outputList = []
+    labelList = []
+    idList = []
+    with torch.set_grad_enabled(optimizer is not None):
+        for batch_data, batch_label, batch_id in dataLoader:
+
+            batch_data = batch_data.to(dev, dtype=torch.float)
+            batch_label = batch_label.reshape(-1, 1).to(dev, dtype=torch.float)
+
+            with torch.autocast(device_type=dev.type, dtype=torch.bfloat16, enabled=bf16):
+                batch_output = net(batch_data).float()
+            batch_loss = loss_fn(batch_output, batch_label)
+
+            if optimizer is not None:
+                optimizer.zero_grad()
+                batch_loss.backward()
+                optimizer.step()
+
+            batch_output = batch_output.detach()
+            total_loss += batch_loss.detach()
+            correct_num += (batch_output.ge(0.5) == batch_label).sum()
+
+            outputList.append(batch_output.reshape(-1))
+            labelList.append(batch_label.reshape(-1))
+            idList.append(batch_id)
+            num += len(batch_id)
+
+    if num == 0:
+        # an empty split, e.g. shards without M or U rows in it
+        empty = np.zeros(0, dtype=np.float32)
+        return float('nan'), float('nan'), empty, empty, np.zeros(0, dtype=np.int64)
+
+    loss = total_loss.item() / num
+    acc = (correct_num / num * 100).item()
+
+    return loss, acc, torch.cat(outputList).cpu().numpy(), torch.cat(labelList).cpu().numpy(), torch.cat(idList).numpy()
+
+
+# area under the ROC curve, nan when the labels do not hold both classes (an empty split)
+def auc_score(labels, outputs):
+    if len(np.unique(labels)) < 2:
+        return float('nan')
+    return roc_auc_score(labels, outputs)
+
+
+# save everything needed to continue training after a restart, replacing the file atomically
+def save_checkpoint(checkpoint_path, net, optimizer, state):
+
+    checkpoint = dict(state)
+    checkpoint['model'] = net.state_dict()
+    checkpoint['optimizer'] = optimizer.state_dict()
+    checkpoint['rng'] = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate(),
+                         'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+    torch.save(checkpoint, checkpoint_path+'.tmp')
+    os.replace(checkpoint_path+'.tmp', checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path):
+    return torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+
+
+# restore net, optimizer and RNG states from a loaded checkpoint, and return the saved training state
+def restore_checkpoint(checkpoint, net, optimizer):
+
+    checkpoint = dict(checkpoint)
+    net.load_state_dict(checkpoint.pop('model'))
+    optimizer.load_state_dict(checkpoint.pop('optimizer'))
+    rng = checkpoint.pop('rng')
+    torch.set_rng_state(rng['torch'])
+    np.random.set_state(rng['numpy'])
+    random.setstate(rng['python'])
+    if rng['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+
+    return checkpoint
 
 
 # define logger  
@@ -142,14 +508,18 @@ def main(args):
     
     data_file = args.data_file
     output_path = args.output_path
+    checkpoint_path = args.checkpoint or output_path+'/checkpoint.pt'
     
     sys.stdout = Logger(output_path+'/log.txt')
 
-    # data parameters
-    TRAIN_PRO = 0.7
-    VALID_PRO = 0.15
-    TEST_PRO = 0.15
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
 
+    checkpoint = None
+    if args.resume and os.path.exists(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+
+    # data parameters (TRAIN_PRO, VALID_PRO, TEST_PRO at the top)
     BATCH_SIZE = 64
     
     
@@ -164,45 +534,56 @@ def main(args):
     
     # training parameters
     lr = 0.001
-    epoches = 100
+    epoches = args.epochs
+    patience = args.patience    # stop after this many epochs without a lower validation loss
 
     # ============ data processing =======================
     print('data processing ...')
-    
-    # get number for two classes and summarize the info into cg_dict
-    cg_dict, M_num, U_num, M_id, U_id = data_summary(data_file)
-#     print("Load data info: M: {}, U:{}".format(M_num, U_num))
-
+    print('training: validation: testing is {}:{}:{}'.format(TRAIN_PRO, VALID_PRO, TEST_PRO))
 
-    # down sampling
-    if M_num > U_num:
-        total_data = U_num
-        M_new_id = np.random.choice(M_id, total_data, replace=False)
-        U_new_id = U_id
+    if args.data_dir:
+        # cohort mode: per-sample shards, split row by row with a fixed seed, balanced within each shard
+        store = ShardStore(list_shards(args.data_dir), args.shard_cache or output_path+'/shard_cache',
+                           args.context_index, args.max_shards)
+        os.makedirs(store.cache_dir, exist_ok=True)
+        shards = [os.path.abspath(shard_file) for shard_file in store.shard_files]
+        if checkpoint is not None and checkpoint.get('shards') != shards:
+            raise ValueError('checkpoint {} was made from different shards'.format(checkpoint_path))
+        num_cpg = train_id = valid_id = test_id = None
+
+        trainDataLoader = build_shard_dataloader(ShardedDataset(store, 'train', BATCH_SIZE, shuffle=True), args.workers)
+        validDataLoader = build_shard_dataloader(ShardedDataset(store, 'valid', BATCH_SIZE, shuffle=False), args.workers)
+        testDataLoader = build_shard_dataloader(ShardedDataset(store, 'test', BATCH_SIZE, shuffle=False), args.workers)
+        describe = store.describe
     else:
-        total_data = M_num
-        M_new_id = M_id
-        U_new_id = np.random.choice(U_id, total_data, replace=False)
-    print('training: validation: testing is {}:{}:{}'.format(TRAIN_PRO, VALID_PRO, TEST_PRO))
+        shards = None
+        context_index = load_context_index(args.context_index) if args.context_index else None
 
+        # get number for two classes and load the info into cg_data columns
+        cg_data, M_num, U_num, M_id, U_id = data_summary(data_file, context_index)
+#         print("Load data info: M: {}, U:{}".format(M_num, U_num))
+        num_cpg = len(cg_data['label'])
 
-    # get train, valid and test dataset id
-    [M_train, M_test, U_train, U_test] = train_test_split(M_new_id, U_new_id, test_size=VALID_PRO+TEST_PRO, random_state=10)
-    [M_val, M_test, U_val, U_test] = train_test_split(M_test, U_test, test_size=TEST_PRO/(TEST_PRO+VALID_PRO), random_state=10)
-    
-    train_id = list(M_train) + list(U_train)
-    valid_id = list(M_val) + list(U_val)
-    test_id = list(M_test) + list(U_test)
+        if checkpoint is not None:
+            # a resumed run keeps the split of the interrupted one
+            if checkpoint['num_cpg'] != num_cpg:
+                raise ValueError('checkpoint {} was made from a different data file'.format(checkpoint_path))
+            train_id, valid_id, test_id = checkpoint['train_id'], checkpoint['valid_id'], checkpoint['test_id']
+        else:
+            train_id, valid_id, test_id = split_ids(M_id, U_id)
+
+        # encode every CpG once, then create data loader
+        features = load_features(cg_data, args.feature_cache, cache_source(data_file, args.context_index))
 
-    # create data loader
-    train_data = TorchDataset(cg_dict, train_id)
-    trainDataLoader = DataLoader(dataset=train_data, batch_size = BATCH_SIZE, shuffle=True)
+        train_data = build_dataset(features, cg_data, train_id)
+        trainDataLoader = build_dataloader(train_data, BATCH_SIZE, shuffle=True)
 
-    valid_data = TorchDataset(cg_dict, valid_id)
-    validDataLoader = DataLoader(dataset=valid_data, batch_size = BATCH_SIZE, shuffle=False)
+        valid_data = build_dataset(features, cg_data, valid_id)
+        validDataLoader = build_dataloader(valid_data, BATCH_SIZE, shuffle=False)
 
-    test_data = TorchDataset(cg_dict, test_id)
-    testDataLoader = DataLoader(dataset=test_data, batch_size = BATCH_SIZE, shuffle=False)
+        test_data = build_dataset(features, cg_data, test_id)
+        testDataLoader = build_dataloader(test_data, BATCH_SIZE, shuffle=False)
+        describe = lambda ids: (cg_data['chrom'][ids], cg_data['p1'][ids].astype(np.int64))
 
 
     # ============ model building =======================
@@ -220,87 +601,66 @@ def main(args):
     # ============ training and validation =======================
     print('training...')
     
-    bestValidLoss = 1000000
-    bestValidAcc = 0
-    train_loss_list = []
-    valid_loss_list = []
-    train_acc_list = []
-    valid_acc_list = []
-    for epoch in range(epoches):
+    state = {'epoch': 0, 'num_cpg': num_cpg, 'shards': shards, 'train_id': train_id, 'valid_id': valid_id, 'test_id': test_id,
+             'bestValidLoss': 1000000, 'bestValidAcc': 0, 'valid_auc': None, 'stale_epochs': 0, 'stopped': False,
+             'train_loss_list': [], 'valid_loss_list': [], 'train_acc_list': [], 'valid_acc_list': []}
+    if checkpoint is not None:
+        state = restore_checkpoint(checkpoint, net, optimizer)
+        print('resuming after epoch {}'.format(state['epoch']))
+
+    train_auc = None
+    for epoch in range(state['epoch'], epoches):
+        if state['stopped']:
+            break
 
         net.train()
-        train_loss = 0
-        train_correct_num = 0
-        trainOutputList = []
-        trainPredictList = []
-        trainLabelList = []
-        for batch_idx, (batch_data, batch_label, batch_id) in enumerate(trainDataLoader):
-
-            batch_data = batch_data.to(dev, dtype=torch.float)
-            batch_label = batch_label.reshape(-1, 1).to(dev, dtype=torch.float)
-
-            optimizer.zero_grad()
-            batch_output = net(batch_data)
-
-            batch_loss = loss_fn(batch_output, batch_label)
-            batch_loss.backward()
-            optimizer.step()
-
-            train_loss += batch_loss.item()
-            train_correct_num += sum(batch_output.cpu().detach().ge(0.5)==batch_label.cpu().detach())
-
-            trainOutputList = trainOutputList + batch_output.cpu().detach().numpy().reshape(-1).tolist()
-            trainPredictList = trainPredictList + batch_output.cpu().detach().ge(0.5).numpy().reshape(-1).tolist()
-            trainLabelList = trainLabelList + batch_label.cpu().detach().numpy().reshape(-1).tolist()
-
-        train_loss /= len(trainDataLoader.dataset)
-        train_acc = (train_correct_num / len(trainDataLoader.dataset) * 100).item()
-        train_auc = roc_auc_score(np.array(trainLabelList), np.array(trainOutputList))
+        train_loss, train_acc, trainOutputList, trainLabelList, _ = run_epoch(net, trainDataLoader, loss_fn, dev, optimizer, args.bf16)
+        train_auc = auc_score(trainLabelList, trainOutputList)
 
 
         net.eval()
-        valid_loss = 0
-        valid_correct_num = 0
-        validOutputList = []
-        validPredictList = []
-        validLabelList = []
-        with torch.no_grad():
-            for batch_data, batch_label, batch_id in validDataLoader:
-
-                batch_data = batch_data.to(dev, dtype=torch.float)
-                batch_label = batch_label.reshape(-1, 1).to(dev, dtype=torch.float)
-
-                batch_output = net(batch_data)
-
-                valid_loss += loss_fn(batch_output, batch_label).item()          
-                valid_correct_num += sum(batch_output.cpu().detach().ge(0.5)==batch_label.cpu().detach())
-
-                validOutputList = validOutputList + batch_output.cpu().detach().numpy().reshape(-1).tolist()
-                validPredictList = validPredictList + batch_output.cpu().detach().ge(0.5).numpy().reshape(-1).tolist()
-                validLabelList = validLabelList + batch_label.cpu().detach().numpy().reshape(-1).tolist()
-
-        valid_loss /= len(validDataLoader.dataset)
-        valid_acc = (valid_correct_num / len(validDataLoader.dataset) * 100).item()
+        valid_loss, valid_acc, validOutputList, validLabelList, _ = run_epoch(net, validDataLoader, loss_fn, dev, bf16=args.bf16)
         print('Epoch: {} | training_loss: {} | training_acc: {}% | validation_loss: {} | validation_acc: {}%'.format(epoch+1, train_loss, train_acc, valid_loss, valid_acc))
 
-        train_loss_list.append(train_loss)
-        valid_loss_list.append(valid_loss)
-        train_acc_list.append(train_acc)
-        valid_acc_list.append(valid_acc)
+        state['train_loss_list'].append(train_loss)
+        state['valid_loss_list'].append(valid_loss)
+        state['train_acc_list'].append(train_acc)
+        state['valid_acc_list'].append(valid_acc)
 
-        if valid_loss < bestValidLoss:
-            bestValidLoss = valid_loss
-            bestValidAcc = valid_acc            
+        if valid_loss < state['bestValidLoss']:
+            state['bestValidLoss'] = valid_loss
+            state['bestValidAcc'] = valid_acc
+            state['stale_epochs'] = 0
 #             print('saving model...')
             modelPath = output_path+'/best_model.pt'
             torch.save(net.state_dict(), modelPath)
 #             fw = open('validResult.txt', 'w')
 #             fw.write('label'+'\t'+'output'+'\t'+'predict'+'\n')
 #             for idx in range(len(validOutputList)):
-#                 fw.write(str(validLabelList[idx])+'\t'+str(validOutputList[idx])+'\t'+str(validPredictList[idx])+'\n')
+#                 fw.write(str(validLabelList[idx])+'\t'+str(validOutputList[idx])+'\t'+str(validOutputList[idx] >= 0.5)+'\n')
 #             fw.close()
-            valid_auc = roc_auc_score(np.array(validLabelList), np.array(validOutputList))
+            state['valid_auc'] = auc_score(validLabelList, validOutputList)
+        else:
+            state['stale_epochs'] += 1
+
+        if patience is not None and state['stale_epochs'] >= patience:
+            print('early stopping: no lower validation loss in {} epochs'.format(patience))
+            state['stopped'] = True
+
+        state['epoch'] = epoch + 1
+        save_checkpoint(checkpoint_path, net, optimizer, state)
+
+    # an early stopped run is tested with the model of the lowest validation loss, not that of the last epoch
+    modelPath = output_path+'/best_model.pt'
+    if state['stopped'] and os.path.exists(modelPath):
+        net.load_state_dict(torch.load(modelPath, map_location=dev))
+    if train_auc is None:
+        # no epoch ran (a resumed run that had already finished): the training auc of the model that is tested
+        net.eval()
+        _, _, trainOutputList, trainLabelList, _ = run_epoch(net, trainDataLoader, loss_fn, dev, bf16=args.bf16)
+        train_auc = auc_score(trainLabelList, trainOutputList)
 
+    valid_auc = state['valid_auc']
     print('training finish =====================')
     print("trainingg auc: {}".format(train_auc))
     print("validation_auc: {}".format(valid_auc))
@@ -311,41 +671,16 @@ def main(args):
     print("testing...")
 
     net.eval()
-    test_loss = 0
-    test_correct_num = 0
-    testOutputList = []
-    testPredictList = []
-    testLabelList = []
-    testIdList = []
-    with torch.no_grad():
-        for batch_data, batch_label, batch_id in testDataLoader:
-            
-            batch_data = batch_data.to(dev, dtype=torch.float)
-            batch_label = batch_label.reshape(-1, 1).to(dev, dtype=torch.float)
-
-            batch_output = net(batch_data)
-
-            test_loss += loss_fn(batch_output, batch_label).item()          
-            test_correct_num += sum(batch_output.cpu().detach().ge(0.5)==batch_label.cpu().detach())
-
-            testOutputList = testOutputList + batch_output.cpu().detach().numpy().reshape(-1).tolist()
-            testPredictList = testPredictList + batch_output.cpu().detach().ge(0.5).numpy().reshape(-1).tolist()
-            testLabelList = testLabelList + batch_label.cpu().detach().numpy().reshape(-1).tolist()
-            testIdList = testIdList + list(batch_id)
-
-
-    test_loss /= len(testDataLoader.dataset)
-    test_acc = (test_correct_num / len(testDataLoader.dataset) * 100).item()
+    test_loss, test_acc, testOutputList, testLabelList, testIdList = run_epoch(net, testDataLoader, loss_fn, dev)
+    testPredictList = testOutputList >= 0.5
 
-    fw = open(output_path+'/testResult.txt', 'w')
-    fw.write('chr\t'+'p1\t'+'p2\t'+'label\t'+'output\t'+'predict\n')
-    for idx in range(len(testOutputList)):
-        chr = testIdList[idx].split(':')[0]
-        start = testIdList[idx].split(':')[1]
-        end = str(int(start)+12)
-        fw.write(chr+'\t'+start+'\t'+end+'\t'+str(testLabelList[idx])+'\t'+str(testOutputList[idx])+'\t'+str(testPredictList[idx])+'\n')
-    fw.close()
-    test_auc = roc_auc_score(np.array(testLabelList), np.array(testOutputList))
+    chrs, starts = describe(testIdList)
+    lines = ['chr\t'+'p1\t'+'p2\t'+'label\t'+'output\t'+'predict\n']
+    for chr, start, label, output, predict in zip(chrs, starts.tolist(), testLabelList.tolist(), testOutputList.tolist(), testPredictList.tolist()):
+        lines.append(chr+'\t'+str(start)+'\t'+str(start+12)+'\t'+str(label)+'\t'+str(output)+'\t'+str(predict)+'\n')
+    with open(output_path+'/testResult.txt', 'w') as fw:
+        fw.write(''.join(lines))
+    test_auc = auc_score(testLabelList, testOutputList)
 
     print('testing finish =====================')
     print("testing auc: {}".format(test_auc))
@@ -356,6 +691,18 @@ def argparser():
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter, add_help=True)
     parser.add_argument('--data_file', default=None, type=str)
     parser.add_argument('--output_path', default=None, type=str)
+    parser.add_argument('--data_dir', default=None, type=str, help='directory or manifest of per-sample feature files, instead of --data_file')
+    parser.add_argument('--shard_cache', default=None, type=str, help='cache of the parsed shards, default <output_path>/shard_cache')
+    parser.add_argument('--max_shards', default=MAX_SHARDS, type=int, help='shards held in memory at a time, per DataLoader worker')
+    parser.add_argument('--workers', default=0, type=int, help='DataLoader worker processes for --data_dir')
+    parser.add_argument('--context_index', default=None, type=str)
+    parser.add_argument('--feature_cache', default=None, type=str, help='.npy file of the encoded features, reused across runs')
+    parser.add_argument('--epochs', default=100, type=int)
+    parser.add_argument('--patience', default=None, type=int, help='early stopping patience in epochs, off by default')
+    parser.add_argument('--checkpoint', default=None, type=str, help='checkpoint file, default <output_path>/checkpoint.pt')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint if it exists')
+    parser.add_argument('--bf16', action='store_true', help='bfloat16 autocast for the forward pass')
+    parser.add_argument('--num_threads', default=None, type=int, help='torch CPU threads')
 
     args = parser.parse_args()
 
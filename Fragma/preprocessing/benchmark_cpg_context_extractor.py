@@ -0,0 +1,48 @@
+import argparse
+import csv
+import itertools
+import time
+
+from cpg_context_extractor import fetch_sequence, ReferenceGenome
+
+def read_rows(bedgraph_file, max_rows):
+    with open(bedgraph_file, 'r') as infile:
+        return list(itertools.islice(csv.reader(infile, delimiter='\t'), max_rows))
+
+def time_per_row(rows, reference_genome):
+    start_time = time.time()
+    contexts = [fetch_sequence(reference_genome, row[0], int(row[1])) for row in rows]
+    return contexts, time.time() - start_time
+
+def time_batched(rows, reference_genome):
+    start_time = time.time()
+    contexts = []
+    with ReferenceGenome(reference_genome) as reference:
+        for chromosome, batch in itertools.groupby(rows, key=lambda row: row[0]):
+            batch = list(batch)
+            contexts.extend(reference.fetch_contexts(chromosome, [int(row[1]) for row in batch]))
+    return contexts, time.time() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CpG context throughput of the per-row and the batched extractor.")
+    parser.add_argument("bedgraph_file", help="Path to a sorted bedgraph file")
+    parser.add_argument("reference_genome", help="Path to the reference genome in fasta format")
+    parser.add_argument("--rows", type=int, default=20000, help="Number of bedgraph rows to benchmark")
+    args = parser.parse_args()
+
+    rows = read_rows(args.bedgraph_file, args.rows)
+
+    per_row_contexts, per_row_time = time_per_row(rows, args.reference_genome)
+    batched_contexts, batched_time = time_batched(rows, args.reference_genome)
+
+    if per_row_contexts != batched_contexts:
+        raise SystemExit("Batched contexts differ from the per-row contexts")
+
+    # the batched time includes loading each chromosome into memory
+    print(f"CpGs: {len(rows)}")
+    print(f"per-row fetch_sequence: {len(rows) / per_row_time:.0f} CpGs/sec ({per_row_time:.2f} s)")
+    print(f"batched ReferenceGenome: {len(rows) / batched_time:.0f} CpGs/sec ({batched_time:.2f} s)")
+    print(f"speedup: {per_row_time / batched_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,20 @@
+import os
+import io
+import shutil
+import tempfile
 import pysam
-import csv
 import argparse
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cpg_context_index import CpGContextIndex
+
+CONTEXT_UPSTREAM = 5
+CONTEXT_DOWNSTREAM = 7
+BATCH_SIZE = 100000
+LINE_TERMINATOR = '\r\n'  # same line ending csv.writer produced
+SHARDS_PER_WORKER = 4
 
 def fetch_sequence(reference_genome, chromosome, start):
     """Fetch 12nt genomic context around the CpG site from the reference genome"""
@@ -12,34 +25,229 @@ def fetch_sequence(reference_genome, chromosome, start):
             sequence = None  # Ignore errors
     return sequence
 
-def process_bedgraph(bedgraph_file, reference_genome, output_file, threshold_m=70, threshold_u=30):
-    with open(bedgraph_file, 'r') as infile, open(output_file, 'w', newline='') as outfile:
-        reader = csv.reader(infile, delimiter='\t')
-        writer = csv.writer(outfile, delimiter='\t')
+class ReferenceGenome:
+    """Reference genome opened once per process, one chromosome held in memory.
+
+    A sorted bedgraph visits each chromosome in a single run, so every chromosome
+    is read from the FASTA once and all of its contexts are sliced from the buffer.
+    Results are the same as fetch_sequence: None when the context starts before
+    the chromosome, truncated near the chromosome end.
+    """
+
+    def __init__(self, reference_genome):
+        self.fasta = pysam.FastaFile(reference_genome)
+        self.chromosome = None
+        self.sequence = None
+        self.buffer = None
+
+    def load(self, chromosome):
+        if chromosome != self.chromosome:
+            self.sequence = self.fasta.fetch(chromosome)
+            self.buffer = np.frombuffer(self.sequence.encode('ascii'), dtype=np.uint8)
+            self.chromosome = chromosome
+        return self.sequence
+
+    def fetch_context(self, chromosome, start):
+        if start - CONTEXT_UPSTREAM < 0:
+            return None
+        sequence = self.load(chromosome)
+        return sequence[start-CONTEXT_UPSTREAM:start+CONTEXT_DOWNSTREAM]
+
+    def fetch_contexts(self, chromosome, starts):
+        """Fetch the 12nt contexts of many CpG starts on one chromosome at once"""
+        sequence = self.load(chromosome)
+        starts = np.asarray(starts, dtype=np.int64)
+        width = CONTEXT_UPSTREAM + CONTEXT_DOWNSTREAM
+        inside = (starts - CONTEXT_UPSTREAM >= 0) & (starts + CONTEXT_DOWNSTREAM <= len(sequence))
+
+        contexts = [None] * len(starts)
+        if inside.any():
+            offsets = starts[inside, None] - CONTEXT_UPSTREAM + np.arange(width)
+            sliced = np.ascontiguousarray(self.buffer[offsets]).view('S%d' % width).ravel()
+            for index, context in zip(np.flatnonzero(inside), sliced):
+                contexts[index] = context.decode('ascii')
+        for index in np.flatnonzero(~inside):
+            contexts[index] = self.fetch_context(chromosome, int(starts[index]))
+        return contexts
+
+    def close(self):
+        self.fasta.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class IndexedReference:
+    """Contexts from a prebuilt CpG context index, with the reference genome as fallback.
+
+    The FASTA is only opened when a start is missing from the index (not a
+    reference CpG, too close to a chromosome end, or containing N).
+    """
+
+    def __init__(self, index_file, reference_genome):
+        self.index = CpGContextIndex(index_file)
+        self.reference_genome = reference_genome
+        self.reference = None
+
+    def fetch_contexts(self, chromosome, starts):
+        starts = np.asarray(starts, dtype=np.int64)
+        contexts = self.index.fetch_contexts(chromosome, starts)
+        missing = [index for index, context in enumerate(contexts) if context is None]
+        if missing:
+            if self.reference is None:
+                self.reference = ReferenceGenome(self.reference_genome)
+            for index, context in zip(missing, self.reference.fetch_contexts(chromosome, starts[missing])):
+                contexts[index] = context
+        return contexts
+
+    def close(self):
+        if self.reference is not None:
+            self.reference.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-        # Get the total number of lines for the progress bar
-        total_lines = sum(1 for line in open(bedgraph_file))
-        infile.seek(0)
+def open_reference(reference_genome, index_file=None):
+    if index_file is None:
+        return ReferenceGenome(reference_genome)
+    return IndexedReference(index_file, reference_genome)
 
-        for row in tqdm(reader, total=total_lines, desc="Processing bedgraph"):
-            chromosome, start, end, methylation_value = row[0], int(row[1]), int(row[2]), float(row[3])
-            methylation_value *= 100  # Scale methylation value from 0-1 to 0-100
-            sequence = fetch_sequence(reference_genome, chromosome, start)
+def read_bedgraph_chunks(infile, chunk_size=BATCH_SIZE):
+    """Parse the first four bedgraph columns into typed chunks of chunk_size rows, none for an empty bedgraph"""
+    try:
+        reader = pd.read_csv(infile, sep='\t', header=None, usecols=[0, 1, 2, 3],
+                             dtype={0: str, 1: np.int64, 2: np.int64, 3: np.float64},
+                             chunksize=chunk_size, float_precision='round_trip')
+    except pd.errors.EmptyDataError:
+        return
+    with reader:
+        yield from reader
+
+def chromosome_runs(chromosomes):
+    """Yield (chromosome, start, stop) for each run of equal chromosome names"""
+    boundaries = np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1
+    edges = np.concatenate(([0], boundaries, [len(chromosomes)]))
+    for start, stop in zip(edges[:-1], edges[1:]):
+        yield chromosomes[start], start, stop
+
+def process_chunk(chunk, reference, threshold_m=70, threshold_u=30):
+    """Label one bedgraph chunk and return its output rows as text"""
+    chromosomes = chunk[0].to_numpy(dtype=object)
+    starts = chunk[1].to_numpy()
+    ends = chunk[2].to_numpy()
+    methylation_values = chunk[3].to_numpy() * 100  # Scale methylation value from 0-1 to 0-100
+
+    # Skip rows where methylation_value is between threshold_u and threshold_m
+    keep = (methylation_values > threshold_m) | (methylation_values < threshold_u)
+    labels = np.where(methylation_values > threshold_m, 'M', 'U')
+
+    lines = []
+    for chromosome, run_start, run_stop in chromosome_runs(chromosomes):
+        rows = run_start + np.flatnonzero(keep[run_start:run_stop])
+        if len(rows) == 0:
+            continue
+        sequences = reference.fetch_contexts(chromosome, starts[rows])
+        for start, end, sequence, methylation_value, label in zip(
+                starts[rows].tolist(), ends[rows].tolist(), sequences,
+                methylation_values[rows].tolist(), labels[rows]):
             if sequence is not None:
-                if methylation_value > threshold_m:
-                    label = 'M'
-                elif methylation_value < threshold_u:
-                    label = 'U'
-                else:
-                    continue  # Skip rows where methylation_value is between 30 and 70
-                writer.writerow([chromosome, start, end, sequence, methylation_value, label])
+                lines.append(f"{chromosome}\t{start}\t{end}\t{sequence}\t{methylation_value!r}\t{label}{LINE_TERMINATOR}")
+    return ''.join(lines)
+
+def process_bedgraph(bedgraph_file, reference_genome, output_file, threshold_m=70, threshold_u=30, index_file=None):
+    # Progress is tracked on bytes read, so the bedgraph is only read once
+    progress = tqdm.wrapattr(open(bedgraph_file, 'rb'), 'read', total=os.path.getsize(bedgraph_file),
+                             desc="Processing bedgraph")
+    with progress as infile, open(output_file, 'w', newline='') as outfile, \
+            open_reference(reference_genome, index_file) as reference:
+        for chunk in read_bedgraph_chunks(infile):
+            outfile.write(process_chunk(chunk, reference, threshold_m, threshold_u))
+
+class ByteRangeReader(io.RawIOBase):
+    """Read-only view of bytes [start, stop) of a file"""
+
+    def __init__(self, path, start, stop):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        count = self.file.readinto(memoryview(buffer)[:size])
+        self.remaining -= count
+        return count
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def shard_offsets(bedgraph_file, num_shards):
+    """Split a file into at most num_shards byte ranges that start at line boundaries"""
+    size = os.path.getsize(bedgraph_file)
+    offsets = [0]
+    with open(bedgraph_file, 'rb') as infile:
+        for shard in range(1, num_shards):
+            infile.seek(size * shard // num_shards)
+            infile.readline()
+            offsets.append(min(infile.tell(), size))
+    offsets.append(size)
+    offsets = sorted(set(offsets))
+    return list(zip(offsets[:-1], offsets[1:]))
+
+# Each worker process keeps its own open reference for all of its shards
+_worker_reference = None
+
+def _init_worker(reference_genome, index_file):
+    global _worker_reference
+    _worker_reference = open_reference(reference_genome, index_file)
+
+def _process_shard(bedgraph_file, start, stop, part_file, threshold_m, threshold_u):
+    with ByteRangeReader(bedgraph_file, start, stop) as infile, open(part_file, 'w', newline='') as outfile:
+        for chunk in read_bedgraph_chunks(io.BufferedReader(infile)):
+            outfile.write(process_chunk(chunk, _worker_reference, threshold_m, threshold_u))
+    return part_file
+
+def process_bedgraph_parallel(bedgraph_file, reference_genome, output_file, workers, threshold_m=70, threshold_u=30,
+                              index_file=None):
+    """Same output as process_bedgraph, with byte-range shards of the bedgraph run in a process pool"""
+    shards = shard_offsets(bedgraph_file, workers * SHARDS_PER_WORKER)
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix='.cpg_context_parts_') as part_dir:
+        part_files = [os.path.join(part_dir, f"part_{index:05d}.tsv") for index in range(len(shards))]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(reference_genome, index_file)) as executor:
+            futures = [executor.submit(_process_shard, bedgraph_file, start, stop, part_file, threshold_m, threshold_u)
+                       for (start, stop), part_file in zip(shards, part_files)]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing bedgraph shards"):
+                future.result()
+
+        # Shards cover the bedgraph in order, so concatenating them restores the single-process output
+        with open(output_file, 'wb') as outfile:
+            for part_file in part_files:
+                with open(part_file, 'rb') as part:
+                    shutil.copyfileobj(part, outfile)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process a bedgraph file to fetch sequences and label methylation values.")
     parser.add_argument("bedgraph_file", help="Path to the bedgraph file")
     parser.add_argument("reference_genome", help="Path to the reference genome in fasta format")
     parser.add_argument("output_file", help="Path to the output file")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes working on this one bedgraph")
+    parser.add_argument("--index", default=None, help="CpG context index built by cpg_context_index.py for this reference")
 
     args = parser.parse_args()
 
-    process_bedgraph(args.bedgraph_file, args.reference_genome, args.output_file)
+    if args.workers > 1:
+        process_bedgraph_parallel(args.bedgraph_file, args.reference_genome, args.output_file, args.workers,
+                                  index_file=args.index)
+    else:
+        process_bedgraph(args.bedgraph_file, args.reference_genome, args.output_file, index_file=args.index)
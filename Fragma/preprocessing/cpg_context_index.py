@@ -0,0 +1,137 @@
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+CONTEXT_UPSTREAM = 5
+CONTEXT_DOWNSTREAM = 7
+CONTEXT_WIDTH = CONTEXT_UPSTREAM + CONTEXT_DOWNSTREAM
+
+MAGIC = b'CPGIDX01'
+ALIGNMENT = 8
+
+# Packed context layout (uint64):
+#   bits 0-23  2-bit base codes, first base in the highest pair (A=0, C=1, G=2, T=3)
+#   bits 24-35 lowercase mask, first base in the highest bit (soft-masked reference)
+#   bit 63     the context has a base other than ACGT and is not stored
+CASE_SHIFT = 2 * CONTEXT_WIDTH
+INVALID = np.uint64(1 << 63)
+MISSING = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[base + 32] = code
+BASE_LETTERS = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+def pack_contexts(buffer, starts):
+    """Pack the 12nt contexts of CpG starts (C positions) from one chromosome buffer"""
+    packed = np.zeros(len(starts), dtype=np.uint64)
+    invalid = np.zeros(len(starts), dtype=bool)
+    for offset in range(CONTEXT_WIDTH):
+        bases = buffer[starts - CONTEXT_UPSTREAM + offset]
+        codes = BASE_CODES[bases]
+        invalid |= codes > 3
+        shift = CONTEXT_WIDTH - 1 - offset
+        packed |= (codes & 3).astype(np.uint64) << np.uint64(2 * shift)
+        packed |= (bases >= ord('a')).astype(np.uint64) << np.uint64(CASE_SHIFT + shift)
+    packed[invalid] = INVALID
+    return packed
+
+def decode_contexts(packed):
+    """Decode packed contexts back to their sequences, as an array of 12-byte strings"""
+    packed = np.asarray(packed, dtype=np.uint64)
+    letters = np.empty((len(packed), CONTEXT_WIDTH), dtype=np.uint8)
+    for offset in range(CONTEXT_WIDTH):
+        shift = CONTEXT_WIDTH - 1 - offset
+        codes = (packed >> np.uint64(2 * shift)) & np.uint64(3)
+        lower = (packed >> np.uint64(CASE_SHIFT + shift)) & np.uint64(1)
+        letters[:, offset] = BASE_LETTERS[codes] + 32 * lower.astype(np.uint8)
+    return letters.view('S%d' % CONTEXT_WIDTH).ravel()
+
+def build_index(reference_genome, index_file):
+    """Write the context of every reference CpG to index_file.
+
+    CpGs closer than the context flanks to a chromosome end are left out;
+    lookups fall back to the reference for them.
+    """
+    import pysam  # only needed to build the index, not to read it
+
+    chromosomes = []
+    positions = []
+    contexts = []
+    total = 0
+    with pysam.FastaFile(reference_genome) as fasta:
+        for chromosome, length in tqdm(zip(fasta.references, fasta.lengths), total=fasta.nreferences,
+                                       desc="Indexing CpG contexts"):
+            buffer = np.frombuffer(fasta.fetch(chromosome).encode('ascii'), dtype=np.uint8)
+            upper = buffer & 0xDF
+            starts = np.flatnonzero((upper[:-1] == ord('C')) & (upper[1:] == ord('G')))
+            starts = starts[(starts >= CONTEXT_UPSTREAM) & (starts + CONTEXT_DOWNSTREAM <= length)]
+            chromosomes.append({'name': chromosome, 'length': length, 'offset': total, 'count': len(starts)})
+            positions.append(starts.astype(np.uint32))
+            contexts.append(pack_contexts(buffer, starts))
+            total += len(starts)
+
+    header = json.dumps({'reference': reference_genome, 'width': CONTEXT_WIDTH,
+                         'count': total, 'chromosomes': chromosomes}).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+    with open(index_file, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(np.uint64(len(header)).tobytes())
+        outfile.write(header)
+        for array in positions:
+            outfile.write(array.tobytes())
+        outfile.write(b'\0' * (-4 * total % ALIGNMENT))
+        for array in contexts:
+            outfile.write(array.tobytes())
+
+class CpGContextIndex:
+    """Memory-mapped index of packed CpG contexts built by build_index"""
+
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as infile:
+            if infile.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{index_file} is not a CpG context index")
+            header_length = int(np.frombuffer(infile.read(8), dtype=np.uint64)[0])
+            header = json.loads(infile.read(header_length))
+
+        data_offset = len(MAGIC) + 8 + header_length
+        count = header['count']
+        self.chromosomes = {entry['name']: entry for entry in header['chromosomes']}
+        self.positions = np.memmap(index_file, dtype=np.uint32, mode='r', offset=data_offset, shape=(count,))
+        contexts_offset = data_offset + 4 * count + (-4 * count % ALIGNMENT)
+        self.contexts = np.memmap(index_file, dtype=np.uint64, mode='r', offset=contexts_offset, shape=(count,))
+
+    def lookup(self, chromosome, starts):
+        """Packed contexts for CpG starts on one chromosome, MISSING where a start is not indexed"""
+        starts = np.asarray(starts, dtype=np.int64)
+        packed = np.full(len(starts), MISSING, dtype=np.uint64)
+        entry = self.chromosomes.get(chromosome)
+        if entry is None or entry['count'] == 0:
+            return packed
+        block = slice(entry['offset'], entry['offset'] + entry['count'])
+        positions = self.positions[block]
+        rows = np.searchsorted(positions, starts)
+        found = rows < len(positions)
+        found[found] = positions[rows[found]] == starts[found]
+        packed[found] = self.contexts[block][rows[found]]
+        return packed
+
+    def fetch_contexts(self, chromosome, starts):
+        """Context strings for CpG starts, None where the index cannot answer"""
+        packed = self.lookup(chromosome, starts)
+        known = (packed & INVALID) == 0
+        contexts = [None] * len(packed)
+        for index, context in zip(np.flatnonzero(known), decode_contexts(packed[known])):
+            contexts[index] = context.decode('ascii')
+        return contexts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a packed 12nt context index of every CpG in a reference genome.")
+    parser.add_argument("reference_genome", help="Path to the reference genome in fasta format")
+    parser.add_argument("index_file", help="Path to the output index file")
+
+    args = parser.parse_args()
+
+    build_index(args.reference_genome, args.index_file)
@@ -1,32 +1,136 @@
+import os
 import pysam
 import argparse
+import gzip
+import json
+import shutil
+import tempfile
+import numpy as np
+from array import array
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def extract_positions(bam_file, mapq_threshold):
-    # Open the BAM file
-    bam = pysam.AlignmentFile(bam_file, "rb")
+# Number of reads held in memory before they are written out
+BUFFER_SIZE = 1000000
 
-    # List to store the read positions
-    positions = []
+# Binary output: gzip stream of MAGIC, uint32 header length, JSON list of
+# chromosome names, then little-endian int32 (chrom id, start, end) records
+MAGIC = b'READPOS1'
+RECORD_DTYPE = np.dtype([('chrom', '<i4'), ('start', '<i4'), ('end', '<i4')])
 
-    # Iterate through each read in the BAM file
-    for read in bam.fetch():
-        # Check if the read's mapping quality is above the threshold
-        if read.mapping_quality >= mapq_threshold:
-            # Extract the start and end positions
-            start = read.reference_start
-            end = read.reference_end
-            # Store the chromosome, start, and end positions
-            positions.append((read.reference_name, start, end))
+def extract_positions(bam_file, mapq_threshold, region=None, bgzf_threads=1):
+    # Open the BAM file, with extra threads for BGZF decompression
+    with pysam.AlignmentFile(bam_file, "rb", threads=bgzf_threads) as bam:
 
-    # Close the BAM file
-    bam.close()
+        # Iterate through each read in the BAM file, or in one (contig, start, stop) region of it
+        if region is None:
+            reads = bam.fetch()
+            region_start = 0
+        else:
+            contig, region_start, region_stop = region
+            reads = bam.fetch(contig, region_start, region_stop)
 
-    return positions
+        for read in reads:
+            # Reads overlapping the region from the left belong to the previous region
+            if read.reference_start < region_start:
+                continue
+            # Check if the read's mapping quality is above the threshold
+            if read.mapping_quality >= mapq_threshold:
+                # Yield the chromosome id, start, and end positions
+                yield read.reference_id, read.reference_start, read.reference_end
 
-def write_positions_to_file(positions, output_file):
+def split_regions(bam_file, tile_size=None):
+    """Split the contigs that have reads into (contig, start, stop) regions in coordinate order.
+
+    Each contig is one region, or consecutive tiles of tile_size bases.
+    """
+    regions = []
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        lengths = dict(zip(bam.references, bam.lengths))
+        contigs_with_reads = {stat.contig for stat in bam.get_index_statistics() if stat.total > 0}
+        for contig in bam.references:
+            if contig not in contigs_with_reads:
+                continue
+            step = tile_size or lengths[contig]
+            for start in range(0, lengths[contig], step):
+                regions.append((contig, start, min(start + step, lengths[contig])))
+    return regions
+
+def get_reference_names(bam_file):
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        return list(bam.references)
+
+def write_positions_to_file(positions, reference_names, output_file, buffer_size=BUFFER_SIZE):
     with open(output_file, 'w') as f:
-        for pos in positions:
-            f.write(f"{pos[0]}\t{pos[1]}\t{pos[2]}\n")
+        lines = []
+        for reference_id, start, end in positions:
+            lines.append(f"{reference_names[reference_id]}\t{start}\t{end}\n")
+            if len(lines) >= buffer_size:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+def binary_header(reference_names):
+    header = json.dumps(reference_names).encode('utf-8')
+    return MAGIC + np.uint32(len(header)).astype('<u4').tobytes() + header
+
+def write_records(f, positions, buffer_size=BUFFER_SIZE):
+    records = array('i')
+    for reference_id, start, end in positions:
+        # reads without an aligned end are stored with end -1
+        records.extend((reference_id, start, -1 if end is None else end))
+        if len(records) >= 3 * buffer_size:
+            f.write(np.frombuffer(records, dtype=np.int32).astype('<i4').tobytes())
+            records = array('i')
+    f.write(np.frombuffer(records, dtype=np.int32).astype('<i4').tobytes())
+
+def write_positions_binary(positions, reference_names, output_file, buffer_size=BUFFER_SIZE):
+    with gzip.open(output_file, 'wb') as f:
+        f.write(binary_header(reference_names))
+        write_records(f, positions, buffer_size)
+
+def read_positions_binary(input_file, chunk_size=BUFFER_SIZE):
+    """Yield (reference_names, records) with up to chunk_size records of RECORD_DTYPE at a time"""
+    with gzip.open(input_file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{input_file} is not a binary read position file")
+        header_length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        reference_names = json.loads(f.read(header_length))
+        while True:
+            data = f.read(chunk_size * RECORD_DTYPE.itemsize)
+            if not data:
+                break
+            yield reference_names, np.frombuffer(data, dtype=RECORD_DTYPE)
+
+def _extract_region(bam_file, mapq_threshold, region, part_file, binary, bgzf_threads):
+    positions = extract_positions(bam_file, mapq_threshold, region, bgzf_threads)
+    if binary:
+        # parts are headerless gzip members, appended after the header member
+        with gzip.open(part_file, 'wb') as f:
+            write_records(f, positions)
+    else:
+        write_positions_to_file(positions, get_reference_names(bam_file), part_file)
+    return part_file
+
+def extract_positions_parallel(bam_file, mapq_threshold, output_file, threads, tile_size=None, binary=False,
+                               bgzf_threads=1):
+    """Scan index regions of the BAM in a process pool and concatenate them in coordinate order"""
+    regions = split_regions(bam_file, tile_size)
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix='.readpos_parts_') as part_dir:
+        part_files = [os.path.join(part_dir, f"part_{index:06d}") for index in range(len(regions))]
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(_extract_region, bam_file, mapq_threshold, region, part_file, binary, bgzf_threads)
+                       for region, part_file in zip(regions, part_files)]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Scanning BAM regions"):
+                future.result()
+
+        with open(output_file, 'wb') as outfile:
+            if binary:
+                outfile.write(gzip.compress(binary_header(get_reference_names(bam_file))))
+            for part_file in part_files:
+                with open(part_file, 'rb') as part:
+                    shutil.copyfileobj(part, outfile)
 
 def main():
     # Create the parser
@@ -36,14 +140,29 @@ def main():
     parser.add_argument('bam_file', type=str, help='Path to the BAM file')
     parser.add_argument('mapq_threshold', type=int, help='MAPQ threshold')
     parser.add_argument('output_file', type=str, help='Path to the output file')
+    parser.add_argument('--binary', action='store_true',
+                        help='Write gzip-compressed int32 (chrom id, start, end) records instead of text')
+    parser.add_argument('--threads', type=int, default=1, help='Number of processes scanning BAM regions')
+    parser.add_argument('--regions', type=str, default='chrom',
+                        help="'chrom' for one region per chromosome, or a tile size in bases")
+    parser.add_argument('--bgzf_threads', type=int, default=1, help='BGZF decompression threads per process')
 
     # Parse the arguments
     args = parser.parse_args()
     print(args.bam_file, args.mapq_threshold,args.output_file)
 
-    # Extract positions and write to file
-    positions = extract_positions(args.bam_file, args.mapq_threshold)
-    write_positions_to_file(positions, args.output_file)
+    # Stream positions to the output file
+    if args.threads > 1:
+        tile_size = None if args.regions == 'chrom' else int(args.regions)
+        extract_positions_parallel(args.bam_file, args.mapq_threshold, args.output_file, args.threads,
+                                   tile_size, args.binary, args.bgzf_threads)
+    else:
+        positions = extract_positions(args.bam_file, args.mapq_threshold, bgzf_threads=args.bgzf_threads)
+        reference_names = get_reference_names(args.bam_file)
+        if args.binary:
+            write_positions_binary(positions, reference_names, args.output_file)
+        else:
+            write_positions_to_file(positions, reference_names, args.output_file)
     print(args.mapq_threshold)
 
    # print(f"Positions extracted and saved to {args.output_file}")
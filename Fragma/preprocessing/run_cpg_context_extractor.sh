@@ -4,8 +4,8 @@
 set -e
 
 # Check if correct number of arguments is provided
-if [ "$#" -ne 3 ]; then
-    echo "Usage: $0 <input_folder> <reference_genome> <number_of_cores>"
+if [ "$#" -ne 3 ] && [ "$#" -ne 4 ]; then
+    echo "Usage: $0 <input_folder> <reference_genome> <number_of_cores> [workers_per_file]"
     exit 1
 fi
 
@@ -13,6 +13,7 @@ fi
 INPUT_FOLDER=$1
 REFERENCE_GENOME=$2
 NUM_CORES=$3
+WORKERS_PER_FILE=${4:-1}
 OUTPUT_FOLDER="${INPUT_FOLDER}_cpgContext"
 
 # Create the output folder if it does not exist
@@ -25,8 +26,11 @@ START_TIME=$(date +%s)
 export OUTPUT_FOLDER
 export REFERENCE_GENOME
 
-# Run the Python script in parallel for each file in the input folder
-find "$INPUT_FOLDER" -type f | parallel -j "$NUM_CORES" python cpg_context_extractor.py {} "$REFERENCE_GENOME" "$OUTPUT_FOLDER/{/.}_output.tsv"
+# Run the Python script in parallel for each file in the input folder,
+# each file itself split over WORKERS_PER_FILE processes
+JOBS=$(( NUM_CORES / WORKERS_PER_FILE ))
+[ "$JOBS" -ge 1 ] || JOBS=1
+find "$INPUT_FOLDER" -type f | parallel -j "$JOBS" python cpg_context_extractor.py {} "$REFERENCE_GENOME" "$OUTPUT_FOLDER/{/.}_output.tsv" --workers "$WORKERS_PER_FILE"
 
 # End timing the script
 END_TIME=$(date +%s)
@@ -0,0 +1,103 @@
+"""
+DATE: 2026/10/18
+FUNC: std_cal_with_cpg_count_mean.py and filter_cpg_std.py for a whole cohort in one run: every sample is
+      grouped into blocks and filtered in memory, the samples spread over a process pool
+INPUT FORMAT: a folder (or a manifest, one path per line) of intersect files as pipe_convertto_monod2MHB.sh
+              makes them, or with --blocks of the sample bedGraphs themselves
+OUTPUT: out_dir/<sample>: chr  start  end  mean of the blocks with std <= std_cutoff and cpg count >= cpg_cutoff,
+        the same as filter_cpg_std.py writes (with --columnar also its .parquet / .arrow table);
+        out_dir_report.txt: blocks, kept blocks, seconds and status (ok or the error) per sample.
+        A failed sample leaves no output, the others are still written, and the run exits with status 1
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from block_stats import CHUNK_SIZE, input_chunks, iter_block_stats
+from filter_cpg_std import COLUMNAR_FORMATS, FilteredWriter
+
+
+def list_samples(input_path):
+	if os.path.isdir(input_path):
+		return sorted(os.path.join(input_path, name) for name in os.listdir(input_path)
+		              if not name.startswith('.') and os.path.isfile(os.path.join(input_path, name)))
+
+	with open(input_path) as f:
+		lines = [line.strip() for line in f]
+	return [os.path.join(os.path.dirname(os.path.abspath(input_path)), line) for line in lines if line and not line.startswith('#')]
+
+
+## std and filter of one sample; returns (blocks, kept blocks, seconds)
+def std_filter_sample(input_file, output_file, cpg_cutoff, std_cutoff, block_file=None, chunk_size=CHUNK_SIZE,
+                      columnar=None):
+	start_time = time.time()
+	num_blocks = 0
+	num_kept = 0
+	with FilteredWriter(output_file, columnar) as writer:
+		for chrom, start, end, counts, means, stds in iter_block_stats(input_chunks(input_file, chunk_size, block_file)):
+			keep = (stds <= std_cutoff) & (counts >= cpg_cutoff)
+			num_blocks += len(keep)
+			num_kept += int(keep.sum())
+			mean_text = np.array([str(m) for m in means[keep].tolist()], dtype=object)
+			writer.write(chrom[keep], start[keep], end[keep], mean_text, means[keep])
+	return num_blocks, num_kept, time.time() - start_time
+
+
+def main(args):
+	samples = list_samples(args.input_path)
+	os.makedirs(args.out_dir, exist_ok=True)
+
+	results = {}
+	errors = {}
+	with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+		futures = {executor.submit(std_filter_sample, sample, os.path.join(args.out_dir, os.path.basename(sample)),
+		                           args.cpg_cutoff, args.std_cutoff, args.blocks, args.chunk_size, args.columnar): sample
+		           for sample in samples}
+		for future in as_completed(futures):
+			sample = futures[future]
+			try:
+				results[sample] = future.result()
+			except Exception as error:
+				results[sample] = None
+				errors[sample] = "{}: {}".format(type(error).__name__, error)
+				output_file = os.path.join(args.out_dir, os.path.basename(sample))
+				if os.path.exists(output_file):
+					os.remove(output_file)
+				print("{}/{} {}: failed, {}".format(len(results), len(samples), os.path.basename(sample), errors[sample]))
+				continue
+			print("{}/{} {}: {} of {} blocks kept, {:.2f}s".format(len(results), len(samples), os.path.basename(sample),
+			                                                       results[sample][1], results[sample][0], results[sample][2]))
+
+	report_file = args.out_dir.rstrip('/') + "_report.txt"
+	with open(report_file, 'w') as outputfile:
+		outputfile.write("sample\tblocks\tkept\tseconds\tstatus\n")
+		for sample in samples:
+			if sample in errors:
+				outputfile.write("{}\tNA\tNA\tNA\tfailed: {}\n".format(os.path.basename(sample), errors[sample].replace('\n', ' ')))
+				continue
+			num_blocks, num_kept, seconds = results[sample]
+			outputfile.write("{}\t{}\t{}\t{:.3f}\tok\n".format(os.path.basename(sample), num_blocks, num_kept, seconds))
+	print("{} samples, {} failed, report saved to {}".format(len(samples), len(errors), report_file))
+	if errors:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Block std and cpg/std filter of every sample of a folder or manifest")
+	parser.add_argument("input_path", help="folder or manifest of intersect files (bedGraphs with --blocks)")
+	parser.add_argument("out_dir", help="folder of the filtered blocks, one file per sample")
+	parser.add_argument("cpg_cutoff", type=int, help="keep blocks with at least this many CpGs (>=)")
+	parser.add_argument("std_cutoff", type=float, help="keep blocks with at most this std (<=)")
+	parser.add_argument("--blocks", default=None, help="bed of non-overlapping blocks to intersect the bedGraphs with")
+	parser.add_argument("--num_workers", default=4, type=int, help="samples processed at the same time")
+	parser.add_argument("--chunk_size", default=CHUNK_SIZE, type=int, help="rows read at a time")
+	parser.add_argument("--columnar", default=None, choices=list(COLUMNAR_FORMATS),
+	                    help="also write the kept blocks of every sample as a parquet or Arrow IPC table")
+	args = parser.parse_args()
+
+	main(args)
@@ -1,29 +1,114 @@
-import time
+### keeps the blocks of a std_cal_with_cpg_count_mean.py output with std <= std_cutoff and cpg count >= cpg_cutoff
+### output will be like chr start end mean, and with --columnar also a .parquet / .arrow table of the same blocks
+
 import os
-import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+# rows read at a time
+CHUNK_SIZE = 5000000
 
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
 
-input_file_name=sys.argv[1]
-out_director=sys.argv[2]
-cpg_cutoff=int(sys.argv[3]) ###>=
-std_cutoff=float(sys.argv[4]) ##<=
 
-out_file_name=out_director+"/"+os.path.basename(input_file_name)
+## (chr, start, end, std, count, mean) chunks, the fields that are written out kept as the text of the file
+## std is read as text too and converted like float() does, so nan stds parse (and fail std <= std_cutoff)
+def read_std_chunks(input_file, chunk_size=CHUNK_SIZE):
+	try:
+		reader = pd.read_csv(input_file, sep='\t', header=None, usecols=[0, 1, 2, 3, 4, 5],
+		                     dtype={0: object, 1: object, 2: object, 3: object, 4: np.int64, 5: object}, na_filter=False,
+		                     chunksize=chunk_size)
+	except pd.errors.EmptyDataError:
+		return
+	with reader:
+		for chunk in reader:
+			columns = [chunk[column].to_numpy() for column in range(6)]
+			columns[3] = columns[3].astype(np.float64)
+			yield tuple(columns)
 
 
-with open (input_file_name) as f:
+## writes the kept blocks as text and, with columnar 'parquet' or 'arrow', as a (chrom, start, end, value) table
+## in output_file + '.parquet' / '.arrow' that is read back without parsing text. The table is written to a .tmp
+## file and renamed when the writer closes without an error; tables of an earlier run are removed either way,
+## so a table next to the text always holds the same blocks.
+## chrom is dictionary encoded per batch in parquet only: the Arrow IPC file format keeps one dictionary for
+## the whole file, and the batches hold different chromosomes, so there it is a plain string column
+class FilteredWriter:
 
-	with open (out_file_name,'w') as outputfile:
-		while True:
-			line=f.readline()
-			if line:
-				
-				if line.strip():
-					str_list=line.split()
-					std=float(str_list[3])
-					cpg=int(str_list[4])
-					if std <=std_cutoff and cpg >=cpg_cutoff:
-						str_to_write=str_list[0]+"\t"+str_list[1]+"\t"+str_list[2]+"\t"+str_list[5]+"\n"
-						outputfile.write(str_to_write)
+	def __init__(self, output_file, columnar=None):
+		for suffix in COLUMNAR_FORMATS.values():
+			if os.path.exists(output_file + suffix):
+				os.remove(output_file + suffix)
+		self.text = open(output_file, 'w')
+		self.table = None
+		if columnar is not None:
+			import pyarrow as pa
+			self.pa = pa
+			self.dictionary = columnar == 'parquet'
+			chrom_type = pa.dictionary(pa.int32(), pa.string()) if self.dictionary else pa.string()
+			self.schema = pa.schema([('chrom', chrom_type), ('start', pa.int64()), ('end', pa.int64()),
+			                         ('value', pa.float64())])
+			self.table_file = output_file + COLUMNAR_FORMATS[columnar]
+			if columnar == 'parquet':
+				import pyarrow.parquet as pq
+				self.table = pq.ParquetWriter(self.table_file + '.tmp', self.schema, compression='zstd')
 			else:
-				break
+				self.table = pa.ipc.new_file(self.table_file + '.tmp', self.schema)
+
+	## chrom, start, end and mean_text are text arrays; mean, the values of mean_text, is parsed from it when not given
+	def write(self, chrom, start, end, mean_text, mean=None):
+		self.text.write(''.join(c+"\t"+s+"\t"+e+"\t"+m+"\n" for c, s, e, m in zip(chrom, start, end, mean_text)))
+		if self.table is not None and len(chrom):
+			pa = self.pa
+			if mean is None:
+				mean = mean_text.astype(np.float64)
+			chrom = pa.array(chrom, type=pa.string())
+			if self.dictionary:
+				chrom = chrom.dictionary_encode()
+			self.table.write_table(pa.Table.from_arrays([chrom, pa.array(start.astype(np.int64)),
+			                                             pa.array(end.astype(np.int64)), pa.array(mean)], schema=self.schema))
+
+	def close(self, completed=True):
+		self.text.close()
+		if self.table is not None:
+			self.table.close()
+			if completed:
+				os.replace(self.table_file + '.tmp', self.table_file)
+			else:
+				os.remove(self.table_file + '.tmp')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *exc):
+		self.close(exc_type is None)
+
+
+## returns (blocks, kept blocks)
+def filter_cpg_std(input_file, output_file, cpg_cutoff, std_cutoff, columnar=None, chunk_size=CHUNK_SIZE):
+	num_blocks = 0
+	num_kept = 0
+	with FilteredWriter(output_file, columnar) as writer:
+		for chrom, start, end, std, cpg, mean in read_std_chunks(input_file, chunk_size):
+			keep = (std <= std_cutoff) & (cpg >= cpg_cutoff)
+			num_blocks += len(keep)
+			num_kept += int(keep.sum())
+			writer.write(chrom[keep], start[keep], end[keep], mean[keep])
+	return num_blocks, num_kept
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Keep the blocks with enough CpGs and a low std")
+	parser.add_argument("input_file", help="std_cal_with_cpg_count_mean.py output")
+	parser.add_argument("out_director")
+	parser.add_argument("cpg_cutoff", type=int, help=">=")
+	parser.add_argument("std_cutoff", type=float, help="<=")
+	parser.add_argument("--columnar", default=None, choices=list(COLUMNAR_FORMATS),
+	                    help="also write the kept blocks as a parquet or Arrow IPC table next to the text output")
+	parser.add_argument("--chunk_size", default=CHUNK_SIZE, type=int, help="rows read at a time")
+	args = parser.parse_args()
+
+	out_file_name = args.out_director+"/"+os.path.basename(args.input_file)
+
+	filter_cpg_std(args.input_file, out_file_name, args.cpg_cutoff, args.std_cutoff, args.columnar, args.chunk_size)
@@ -0,0 +1,175 @@
+"""
+DATE: 2026/10/18
+FUNC: CpG count, mean and population std of the methylation values of each block, streamed over a
+      `bedtools intersect -wa -wb` file in chunks; shared by the std_cal_with_cpg_count*.py scripts.
+      With --blocks the intersect is done here, from the sample bedGraph and the block bed directly
+INPUT FORMAT: tab-separated bedGraph (chr  start  end  value) intersected with blocks (chr  start  end),
+              the rows of a block consecutive; or, with --blocks, the bedGraph itself and a bed of
+              non-overlapping blocks
+OUTPUT: region: chr:start-end  std  count
+        bed:    chr  start  end  std  count  mean
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+
+# rows read at a time
+CHUNK_SIZE = 5000000
+
+VALUE_COLUMN = 3
+BLOCK_COLUMNS = [4, 5, 6]
+
+
+## (chr, start, end, values) of each chunk, the block fields kept as the text of the file
+def read_intersect_chunks(input_file, chunk_size=CHUNK_SIZE):
+	try:
+		# object columns skip the string array conversion; the values are converted like float() does, nan included
+		reader = pd.read_csv(input_file, sep='\t', header=None, usecols=[VALUE_COLUMN] + BLOCK_COLUMNS,
+		                     dtype=object, na_filter=False, chunksize=chunk_size)
+	except pd.errors.EmptyDataError:
+		return
+	with reader:
+		for chunk in reader:
+			yield (chunk[4].to_numpy(dtype=object), chunk[5].to_numpy(dtype=object), chunk[6].to_numpy(dtype=object),
+			       chunk[VALUE_COLUMN].to_numpy(dtype=object).astype(np.float64))
+
+
+## the blocks of a bed file per chromosome: (starts, ends, chr, start, end), sorted by start
+## the text fields are written as they are in the file, like bedtools -wb does
+def read_blocks(block_file):
+	blocks = pd.read_csv(block_file, sep='\t', header=None, usecols=[0, 1, 2], dtype=object, na_filter=False,
+	                     comment='#')
+	index = {}
+	for chrom, group in blocks.groupby(0, sort=False):
+		fields = [group[column].to_numpy(dtype=object) for column in [0, 1, 2]]
+		starts = fields[1].astype(np.int64)
+		order = np.argsort(starts, kind='stable')
+		starts = starts[order]
+		ends = fields[2].astype(np.int64)[order]
+		if (starts[1:] < ends[:-1]).any():
+			raise ValueError('blocks of {} in {} overlap, merge them first (bedtools merge)'.format(chrom, block_file))
+		index[chrom] = (starts, ends) + tuple(field[order] for field in fields)
+	return index
+
+
+## (chr, start, end, value) chunks of a bedGraph, without its track / browser lines
+def read_bedgraph_chunks(bedgraph_file, chunk_size=CHUNK_SIZE):
+	skip = 0
+	with open(bedgraph_file) as f:
+		for line in f:
+			if not line.startswith(('track', 'browser', '#')):
+				break
+			skip += 1
+	try:
+		reader = pd.read_csv(bedgraph_file, sep='\t', header=None, usecols=[0, 1, 2, 3], skiprows=skip,
+		                     dtype={0: object, 1: np.int64, 2: np.int64, 3: object}, na_filter=False,
+		                     chunksize=chunk_size)
+	except pd.errors.EmptyDataError:
+		return
+	with reader:
+		for chunk in reader:
+			yield (chunk[0].to_numpy(dtype=object), chunk[1].to_numpy(), chunk[2].to_numpy(),
+			       chunk[3].to_numpy(dtype=object).astype(np.float64))
+
+
+## the rows of `bedtools intersect -wa -wb -a bedgraph_file -b block_file`, as the chunks of read_intersect_chunks,
+## without writing them: every bedGraph row is looked up in the sorted blocks of its chromosome
+def intersect_chunks(bedgraph_file, block_file, chunk_size=CHUNK_SIZE):
+	blocks = read_blocks(block_file)
+	for chrom, start, end, values in read_bedgraph_chunks(bedgraph_file, chunk_size):
+		edges = np.concatenate(([0], np.flatnonzero(chrom[1:] != chrom[:-1]) + 1, [len(chrom)]))
+		parts = []
+		for lo, hi in zip(edges[:-1].tolist(), edges[1:].tolist()):
+			if chrom[lo] not in blocks:
+				continue
+			block_starts, block_ends, block_chrom, block_start, block_end = blocks[chrom[lo]]
+			# the overlapping blocks of [start, end) are first:stop, the ones ending after start and starting before end
+			first = np.searchsorted(block_ends, start[lo:hi], side='right')
+			hits = np.maximum(np.searchsorted(block_starts, end[lo:hi], side='left') - first, 0)
+			rows = np.repeat(np.arange(lo, hi), hits)
+			block = np.repeat(first - (np.cumsum(hits) - hits), hits) + np.arange(len(rows))
+			parts.append((block_chrom[block], block_start[block], block_end[block], values[rows]))
+		if parts:
+			yield [np.concatenate(column) for column in zip(*parts)]
+
+
+## mean and population std of consecutive groups of values, equal to np.mean / np.std of each group
+def group_stats(values, sizes):
+	starts = np.cumsum(sizes) - sizes
+	means = np.empty(len(sizes))
+	stds = np.empty(len(sizes))
+	# the groups of one size are the rows of a matrix, summed in the same (pairwise) order as np.sum of each group
+	for size in np.unique(sizes):
+		groups = np.flatnonzero(sizes == size)
+		matrix = values[starts[groups, None] + np.arange(size)]
+		mean = matrix.sum(axis=1) / size
+		deviation = matrix - mean[:, None]
+		means[groups] = mean
+		stds[groups] = np.sqrt((deviation * deviation).sum(axis=1) / size)
+	return means, stds
+
+
+## yield (chr, start, end, count, mean, std) arrays of the blocks of each (chr, start, end, values) chunk
+## the last block of a chunk may go on in the next chunk, so it is carried over and finished there
+def iter_block_stats(chunks):
+	carry = None
+	for columns in chunks:
+		if carry is not None:
+			columns = [np.concatenate((old, new)) for old, new in zip(carry, columns)]
+		chrom, start, end, values = columns
+		if len(values) == 0:
+			continue
+		edges = np.concatenate(([0], np.flatnonzero((chrom[1:] != chrom[:-1]) | (start[1:] != start[:-1])
+		                                            | (end[1:] != end[:-1])) + 1))
+		last = edges[-1]
+		carry = [column[last:] for column in columns]
+		edges = edges[:-1]
+		if len(edges):
+			sizes = np.diff(np.append(edges, last))
+			yield (chrom[edges], start[edges], end[edges], sizes) + group_stats(values[:last], sizes)
+	if carry is not None:
+		chrom, start, end, values = carry
+		sizes = np.array([len(values)])
+		yield (chrom[:1], start[:1], end[:1], sizes) + group_stats(values, sizes)
+
+
+def format_region(chrom, start, end, counts, means, stds):
+	return [c+":"+s+"-"+e+"\t"+str(sd)+"\t"+str(n)+"\n"
+	        for c, s, e, n, sd in zip(chrom, start, end, counts.tolist(), stds.tolist())]
+
+
+def format_bed(chrom, start, end, counts, means, stds):
+	return [c+"\t"+s+"\t"+e+"\t"+str(sd)+"\t"+str(n)+"\t"+str(m)+"\n"
+	        for c, s, e, n, m, sd in zip(chrom, start, end, counts.tolist(), means.tolist(), stds.tolist())]
+
+
+FORMATS = {'region': format_region, 'bed': format_bed}
+
+
+## the (chr, start, end, values) chunks of an intersect file, or with a block_file of the sample bedGraph
+def input_chunks(input_file, chunk_size=CHUNK_SIZE, block_file=None):
+	if block_file is None:
+		return read_intersect_chunks(input_file, chunk_size)
+	return intersect_chunks(input_file, block_file, chunk_size)
+
+
+def write_block_stats(input_file, output_file, output_format='region', chunk_size=CHUNK_SIZE, block_file=None):
+	formatter = FORMATS[output_format]
+	with open(output_file, 'w') as outputfile:
+		for stats in iter_block_stats(input_chunks(input_file, chunk_size, block_file)):
+			outputfile.write(''.join(formatter(*stats)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Per-block CpG count, mean and std of a bedtools intersect -wa -wb file")
+	parser.add_argument("input_file", help="bedGraph intersected with blocks, the rows of a block consecutive; "
+	                                       "with --blocks the bedGraph itself")
+	parser.add_argument("output_file")
+	parser.add_argument("--blocks", default=None, help="bed of non-overlapping blocks to intersect input_file with")
+	parser.add_argument("--format", default='region', choices=list(FORMATS),
+	                    help="region: chr:start-end std count; bed: chr start end std count mean")
+	parser.add_argument("--chunk_size", default=CHUNK_SIZE, type=int, help="rows read at a time")
+	args = parser.parse_args()
+
+	write_block_stats(args.input_file, args.output_file, args.format, args.chunk_size, args.blocks)
@@ -6,6 +6,7 @@
 
 import pandas as pd
 import random
+import bisect
 
 
 # In[2]:
@@ -27,9 +28,42 @@ stdfiledf=pd.read_csv(stdfile,sep="\t", header=None)
 # In[3]:
 
 
-def isValidMHB(bdf,randblockstart,randblockend,maxblock,currentblocklist):
-    if isfromsamechrom(bdf,randblockstart,randblockend,maxblock)== True:
-        if ismutuallyexclusive(currentblocklist,bdf,randblockstart,randblockend)==True:
+### the accepted blocks of each chromosome, sorted by start. Blocks that do not overlap each other have sorted
+### ends too, so only the last block starting before the end of a new block can overlap it (bisect, O(log n)).
+### Blocks with end <= start, which only an unsorted bedgraph gives, are kept apart and compared one by one.
+class AcceptedBlocks:
+    def __init__(self):
+        self.starts={}
+        self.ends={}
+        self.others={}
+
+    def add(self,chrom,blockstart,blockend):
+        if blockstart < blockend:
+            starts=self.starts.setdefault(chrom,[])
+            i=bisect.bisect_left(starts,blockstart)
+            starts.insert(i,blockstart)
+            self.ends.setdefault(chrom,[]).insert(i,blockend)
+        else:
+            self.others.setdefault(chrom,[]).append((blockstart,blockend))
+
+    def overlaps(self,chrom,nbstart,nbend):
+        for currentblockstart,currentblockend in self.others.get(chrom,[]):
+            if not (nbstart >= currentblockend or nbend<=currentblockstart):
+                return True
+        starts=self.starts.get(chrom,[])
+        ends=self.ends.get(chrom,[])
+        if nbstart < nbend:
+            i=bisect.bisect_left(starts,nbend)
+            return i > 0 and ends[i-1] > nbstart
+        for currentblockstart,currentblockend in zip(starts,ends):
+            if not (nbstart >= currentblockend or nbend<=currentblockstart):
+                return True
+        return False
+
+
+def isValidMHB(chroms,starts,ends,randblockstart,randblockend,maxblock,acceptedblocks):
+    if isfromsamechrom(chroms,starts,randblockstart,randblockend,maxblock)== True:
+        if ismutuallyexclusive(acceptedblocks,chroms,starts,ends,randblockstart,randblockend)==True:
             return True
         else:
             #print("overlapped")
@@ -38,87 +72,56 @@ def isValidMHB(bdf,randblockstart,randblockend,maxblock,currentblocklist):
         return False
         
 
-def ismutuallyexclusive(currentblocklist,bdf,randblockstart,randblockend):
-    nbchr=bdf.iloc[randblockstart][0]
-    nbstart=bdf.iloc[randblockstart][1]
-    nbend=bdf.iloc[randblockend][2]
-    
-    for i in range(len(currentblocklist)):
-        currentblockchr=currentblocklist[i][0]
-        currentblockstart=currentblocklist[i][1]
-        currentblockend=currentblocklist[i][2]
-        
-        if currentblockchr==nbchr:
-            if nbstart >= currentblockend or nbend<=currentblockstart:
-                pass
-            else:
-                return False
-    
-    return True
-
-
-
+def ismutuallyexclusive(acceptedblocks,chroms,starts,ends,randblockstart,randblockend):
+    return not acceptedblocks.overlaps(chroms[randblockstart],starts[randblockstart],ends[randblockend])
 
 
-
-
-def isfromsamechrom(bdf,randblockstart,randblockend,blocklimit):
+def isfromsamechrom(chroms,starts,randblockstart,randblockend,blocklimit):
   
-    if randblockend >=bdf.shape[0]:
+    if randblockend >=len(chroms):
         return False
     
-    if(bdf.iloc[randblockend][1] - bdf.iloc[randblockstart][1] > blocklimit):
+    if(starts[randblockend] - starts[randblockstart] > blocklimit):
         return False
     
- 
-    startchr=bdf.iloc[randblockstart][0]
-    endchr=bdf.iloc[randblockend][0]  
-    if startchr==endchr:
-        return True
-    else:
-        return False
+    return chroms[randblockstart]==chroms[randblockend]
 
 
 # In[4]:
 
 
 def fullprocess(bdf,stdf,maxblock,maxtry,oname):
-    stddfrunm,stdfcolnum=stdf.shape
-    bdfrnum,bdfcolnum=bdf.shape
+    ### the bedgraph columns as lists, taken once instead of a bdf.iloc per lookup; in the dtype of a bdf.iloc row,
+    ### which is float when every column is numeric (chromosomes named 1, 2, ...)
+    rowdtype=bdf.iloc[:1].to_numpy().dtype
+    chroms=bdf[0].to_numpy(dtype=rowdtype).tolist()
+    starts=bdf[1].to_numpy(dtype=rowdtype).tolist()
+    ends=bdf[2].to_numpy(dtype=rowdtype).tolist()
+    bdfrnum=len(chroms)
     
     random.seed(0)
     
     ###############################################
+    acceptedblocks=AcceptedBlocks()
     allrows=[]
-    for i in range(stddfrunm):
-        currentCpGnum=stdf.iloc[i][2]
-        
-        
+    for currentCpGnum in stdf[2].tolist():
         
         for j in range(maxtry):
             
             randblockstart = random.randint(0, bdfrnum-1)
             randblockend= randblockstart+currentCpGnum-1
 
+            if isValidMHB(chroms,starts,ends,randblockstart,randblockend,maxblock,acceptedblocks)==True:    
 
-            #print(currentCpGnum)
-            #print(randblockstart,randblockend)
-
-            if isValidMHB(bdf,randblockstart,randblockend,maxblock,allrows)==True:    
-                #print("yes")
-
-                newblock=[bdf.iloc[randblockstart][0],bdf.iloc[randblockstart][1],bdf.iloc[randblockend][2]]
+                newblock=[chroms[randblockstart],starts[randblockstart],ends[randblockend]]
+                acceptedblocks.add(*newblock)
                 allrows.append(newblock)
-
-                #print(allrows)
                 
                 break
 
 
     outdf=pd.DataFrame(allrows)
     
-    #print(outdf)
-    
     outdf.to_csv(oname,sep="\t",index=False,header = False)
    
     
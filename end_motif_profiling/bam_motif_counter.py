@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import pysam
+from array import array
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Same read selection as process_motifs.sh (samtools view --min-MQ 30 --require-flags 65 / 129)
+MAPQ_THRESHOLD = 30
+READ1_FLAGS = 65   # paired, first in pair: motif at the start of the aligned interval
+READ2_FLAGS = 129  # paired, second in pair: reverse complement of the motif at the end of the aligned interval
+
+# Reads buffered per chromosome before their motifs are counted
+BATCH_SIZE = 1000000
+
+# Fragment length profiles: row |TLEN| for 1..max_length, row 0 for TLEN 0 (mate on another
+# chromosome or unmapped), row max_length + 1 for longer fragments
+MAX_FRAGMENT_LENGTH = 1000
+
+# 2-bit base codes (A=0, C=1, G=2, T=3, case-insensitive), 4 for any other base
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[base + 32] = code
+
+def motif_names(num_nucleotides):
+    """Motifs in index order: the motif index is its base-4 number with A=0, C=1, G=2, T=3"""
+    return [''.join(p) for p in itertools.product('ACGT', repeat=num_nucleotides)]
+
+class ReferenceCodes:
+    """Reference genome with one chromosome held in memory as 2-bit codes"""
+
+    def __init__(self, reference_genome):
+        self.fasta = pysam.FastaFile(reference_genome)
+        self.chromosome = None
+        self.codes = None
+
+    def load(self, chromosome):
+        if chromosome != self.chromosome:
+            sequence = self.fasta.fetch(chromosome)
+            self.codes = BASE_CODES[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+            self.chromosome = chromosome
+        return self.codes
+
+    def close(self):
+        self.fasta.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def motif_windows(codes, positions, lengths, max_nucleotides, reverse=False):
+    """Codes of the first max_nucleotides bases of each read end motif, and the length of their ACGT prefix.
+
+    Forward motifs start at positions; reverse motifs are the reverse complement
+    of the bases ending at positions. Bases past the aligned interval (lengths)
+    count as invalid, so a prefix never leaves the fragment.
+    """
+    window = np.empty((len(positions), max_nucleotides), dtype=np.uint8)
+    prefix = np.full(len(positions), max_nucleotides, dtype=np.int64)
+    for offset in range(max_nucleotides):
+        if reverse:
+            column = codes[np.maximum(positions - 1 - offset, 0)]
+            column = np.where(column <= 3, 3 - column, 4)  # complement of A/C/G/T is 3 - code
+        else:
+            column = codes[np.minimum(positions + offset, len(codes) - 1)]
+        column[offset >= lengths] = 4
+        window[:, offset] = column
+        prefix[(column > 3) & (prefix == max_nucleotides)] = offset
+    return window, prefix
+
+def prefix_indices(window, num_nucleotides):
+    """Motif indices of the first num_nucleotides codes of each window row"""
+    index = np.zeros(len(window), dtype=np.int64)
+    for offset in range(num_nucleotides):
+        index = index * 4 + window[:, offset]
+    return index
+
+def marginalize(counts, num_nucleotides):
+    """Counts of the num_nucleotides-long prefixes from dense 4^K count vectors along the last axis"""
+    max_nucleotides = int(round(np.log(counts.shape[-1]) / np.log(4)))
+    return counts.reshape(*counts.shape[:-1], 4 ** num_nucleotides, 4 ** (max_nucleotides - num_nucleotides)).sum(axis=-1)
+
+def unsorted_bam_error(bam_file):
+    return ValueError(f"{bam_file} is not sorted by coordinate; sort it with samtools sort first, "
+                      "as every chromosome of the reference is loaded once")
+
+def check_sort_order(bam_file):
+    """Raise when the header of a BAM declares an order other than coordinate (SO:queryname / unsorted)"""
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        sort_order = bam.header.to_dict().get('HD', {}).get('SO', 'unknown')
+    if sort_order in ('queryname', 'unsorted'):
+        raise unsorted_bam_error(bam_file)
+
+def read_end_positions(bam_file, min_nucleotides, mapq_threshold=MAPQ_THRESHOLD, bgzf_threads=1, batch_size=BATCH_SIZE):
+    """Scan a coordinate sorted BAM once and yield (chromosome, ends) in batches of one chromosome.
+
+    ends maps False to the read 1 (start, aligned length, TLEN) arrays and True to
+    the read 2 (end, aligned length, TLEN) arrays, the key being whether the
+    motif is reverse complemented. Reads with an aligned interval shorter than
+    the shortest motif are skipped, like the sed step of process_motifs.sh
+    leaves them out of the motif set. A chromosome seen again after another
+    one raises ValueError, as the BAM is then not sorted by coordinate.
+    """
+    def new_batch():
+        return {False: (array('q'), array('q'), array('q')), True: (array('q'), array('q'), array('q'))}
+
+    with pysam.AlignmentFile(bam_file, "rb", threads=bgzf_threads) as bam:
+        current = None
+        finished = set()
+        ends = new_batch()
+        size = 0
+        for read in bam.fetch(until_eof=True):
+            if read.is_unmapped or read.mapping_quality < mapq_threshold:
+                continue
+            if read.reference_id != current or size >= batch_size:
+                if current is not None:
+                    yield bam.get_reference_name(current), ends
+                if read.reference_id != current:
+                    if read.reference_id in finished:
+                        raise unsorted_bam_error(bam_file)
+                    finished.add(current)
+                current = read.reference_id
+                ends = new_batch()
+                size = 0
+            start = read.reference_start
+            end = read.reference_end
+            if end - start < min_nucleotides:
+                continue
+            flag = read.flag
+            if flag & READ1_FLAGS == READ1_FLAGS:
+                positions, lengths, tlens = ends[False]
+                positions.append(start)
+                lengths.append(end - start)
+                tlens.append(read.template_length)
+                size += 1
+            if flag & READ2_FLAGS == READ2_FLAGS:
+                positions, lengths, tlens = ends[True]
+                positions.append(end)
+                lengths.append(end - start)
+                tlens.append(read.template_length)
+                size += 1
+        if current is not None:
+            yield bam.get_reference_name(current), ends
+
+def length_rows(tlens, max_length):
+    """Fragment length profile row of each TLEN, all 0 without a profile"""
+    if max_length is None:
+        return np.zeros(len(tlens), dtype=np.int64)
+    return np.minimum(np.abs(tlens), max_length + 1)
+
+def count_end_motifs(bam_file, reference_genome, motif_lengths, mapq_threshold=MAPQ_THRESHOLD, bgzf_threads=1,
+                     max_length=None):
+    """{k: fragment end motif counts} of one BAM for every k in motif_lengths, from one scan.
+
+    The counts are dense (1, 4^k) arrays, or with max_length joint fragment
+    length x motif histograms of max_length + 2 rows (see MAX_FRAGMENT_LENGTH).
+    Only the longest k is tallied for every read; shorter spectra are its prefix
+    marginals. Reads whose longest motif has an N, or runs past a fragment
+    shorter than it, add their valid shorter prefixes on top, so every spectrum
+    equals counting that k on its own.
+    """
+    motif_lengths = sorted(set(motif_lengths))
+    max_nucleotides = motif_lengths[-1]
+    num_rows = 1 if max_length is None else max_length + 2
+    counts = np.zeros((num_rows, 4 ** max_nucleotides), dtype=np.int64)
+    partial = {k: np.zeros((num_rows, 4 ** k), dtype=np.int64) for k in motif_lengths[:-1]}
+
+    def tally(histogram, rows, indices):
+        histogram += np.bincount(rows * histogram.shape[1] + indices, minlength=histogram.size).reshape(histogram.shape)
+
+    with ReferenceCodes(reference_genome) as reference:
+        for chromosome, ends in read_end_positions(bam_file, motif_lengths[0], mapq_threshold, bgzf_threads):
+            codes = reference.load(chromosome)
+            for reverse, (positions, lengths, tlens) in ends.items():
+                if len(positions) == 0:
+                    continue
+                window, prefix = motif_windows(codes, np.frombuffer(positions, dtype=np.int64),
+                                               np.frombuffer(lengths, dtype=np.int64), max_nucleotides, reverse)
+                rows = length_rows(np.frombuffer(tlens, dtype=np.int64), max_length)
+                full = prefix == max_nucleotides
+                tally(counts, rows[full], prefix_indices(window[full], max_nucleotides))
+                for k, histogram in partial.items():
+                    selected = ~full & (prefix >= k)
+                    tally(histogram, rows[selected], prefix_indices(window[selected], k))
+    spectra = {k: marginalize(counts, k) + histogram for k, histogram in partial.items()}
+    spectra[max_nucleotides] = counts
+    return spectra
+
+def length_window(profile, min_length, max_length):
+    """Motif counts of fragments with min_length <= |TLEN| <= max_length from a joint length x motif histogram"""
+    rows = profile.shape[0] - 2
+    if min_length < 1 or max_length > rows:
+        raise ValueError(f"the profile covers fragment lengths 1 to {rows}")
+    return profile[min_length:max_length + 1].sum(axis=0)
+
+def _count_bam(bam_file, reference_genome, motif_lengths, mapq_threshold, bgzf_threads, profile_file, max_length):
+    spectra = count_end_motifs(bam_file, reference_genome, motif_lengths, mapq_threshold, bgzf_threads,
+                               max_length if profile_file else None)
+    if profile_file:
+        np.savez_compressed(profile_file, max_length=max_length, **{f"k{k}": counts for k, counts in spectra.items()})
+    return {k: counts.sum(axis=0) for k, counts in spectra.items()}
+
+def list_bam_files(input_path):
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, name) for name in os.listdir(input_path) if name.endswith('.bam'))
+    return [input_path]
+
+def count_motifs_in_bams(bam_files, reference_genome, motif_lengths, num_cores, mapq_threshold=MAPQ_THRESHOLD, bgzf_threads=1,
+                         profile_dir=None, max_length=MAX_FRAGMENT_LENGTH):
+    """{k: motif x sample count matrix}, samples named like the _motifs.txt files of pipe_process_motifs.sh
+
+    With profile_dir, the fragment length x motif histograms of every BAM are
+    also saved there as <bam name>.npz (arrays max_length and k<k>).
+    """
+    columns = [os.path.basename(bam_file)[:-len('.bam')] + '_motifs.txt' for bam_file in bam_files]
+    counts = {k: np.zeros((len(bam_files), 4 ** k), dtype=np.int64) for k in motif_lengths}
+    with ProcessPoolExecutor(max_workers=num_cores) as executor:
+        future_to_row = {}
+        for row, bam_file in enumerate(bam_files):
+            profile_file = os.path.join(profile_dir, os.path.basename(bam_file)[:-len('.bam')] + '.npz') if profile_dir else None
+            future = executor.submit(_count_bam, bam_file, reference_genome, motif_lengths, mapq_threshold, bgzf_threads,
+                                     profile_file, max_length)
+            future_to_row[future] = row
+        for future in tqdm(as_completed(future_to_row), total=len(bam_files), desc="Processing BAMs"):
+            for k, vector in future.result().items():
+                counts[k][future_to_row[future]] = vector
+    return {k: pd.DataFrame(counts[k].T, index=motif_names(k), columns=columns) for k in motif_lengths}
+
+def main():
+    parser = argparse.ArgumentParser(description="Count fragment end motifs straight from BAM files, without the per-read motif text files of process_motifs.sh.")
+    parser.add_argument("input_path", help="Folder of BAM files, or one BAM file, sorted by coordinate (samtools sort)")
+    parser.add_argument("reference_genome", help="Path to the reference genome in fasta format (with .fai index)")
+    parser.add_argument("n_motif", help="Motif length, or comma separated lengths (e.g. 1,2,3,4,6) counted in one scan")
+    parser.add_argument("num_cores", type=int, help="Number of BAM files counted at the same time")
+    parser.add_argument("--output_prefix", default=None,
+                        help="Matrices are written to <output_prefix><n_motif>.txt, default <input_folder>_motifs_ as from pipe_process_motifs.sh and the counter")
+    parser.add_argument("--mapq", type=int, default=MAPQ_THRESHOLD, help="Minimum mapping quality")
+    parser.add_argument("--bgzf_threads", type=int, default=1, help="BGZF decompression threads per BAM")
+    parser.add_argument("--length_profile", default=None,
+                        help="Folder for the fragment length (|TLEN|) x motif histogram of each BAM, sliced by motif_length_window.py")
+    parser.add_argument("--max_length", type=int, default=MAX_FRAGMENT_LENGTH,
+                        help="Longest fragment length with its own profile row")
+    args = parser.parse_args()
+
+    bam_files = list_bam_files(args.input_path)
+    if not bam_files:
+        sys.exit(f"No BAM files found in {args.input_path}")
+    for bam_file in bam_files:
+        try:
+            check_sort_order(bam_file)
+        except ValueError as error:
+            sys.exit(str(error))
+    motif_lengths = sorted({int(k) for k in args.n_motif.split(',')})
+    output_prefix = args.output_prefix or f"{args.input_path.rstrip('/')}_motifs_"
+
+    start_time = time.time()
+    if args.length_profile:
+        os.makedirs(args.length_profile, exist_ok=True)
+    motif_counts = count_motifs_in_bams(bam_files, args.reference_genome, motif_lengths, args.num_cores, args.mapq,
+                                        args.bgzf_threads, args.length_profile, args.max_length)
+    end_time = time.time()
+
+    print(f"Processed in {end_time - start_time:.2f} seconds.")
+    for k, motif_counts_df in motif_counts.items():
+        output_file = f"{output_prefix}{k}.txt"
+        motif_counts_df.to_csv(output_file, sep='\t')
+        print(f"Motif counts saved to {output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,280 @@
 import itertools
+import hashlib
+import argparse
+import numpy as np
 import pandas as pd
-import sys
 import os
 from tqdm import tqdm
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed  # Import as_completed
-from collections import Counter
 
-def create_motif_dataframe(num_nucleotides, file_names):
+# Bytes read at a time from a motif file
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Files are counted in byte ranges of about this size, so one large sample is spread over all cores
+RANGE_SIZE = 256 * 1024 * 1024
+
+# Per-sample count vectors of earlier runs are kept next to the output matrix
+CACHE_SUFFIX = '.motif_cache.npz'
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# 2-bit base codes (A=0, C=1, G=2, T=3, case-insensitive), 4 for any other byte
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[base + 32] = code
+
+# Bytes other than \n that str.strip() removes or that end a line in text mode (\r), plus non-ASCII bytes
+SPECIAL_BYTES = np.zeros(256, dtype=bool)
+SPECIAL_BYTES[[9, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+SPECIAL_BYTES[128:] = True
+
+def motif_names(num_nucleotides):
+    """Motifs in index order: the motif index is its base-4 number with A=0, C=1, G=2, T=3"""
     nucleotides = 'ACGT'
-    motifs = [''.join(p) for p in itertools.product(nucleotides, repeat=num_nucleotides)]
-    motif_df = pd.DataFrame(0, index=motifs, columns=file_names)
-    return motif_df
-
-def process_file(file_path, motifs_set):
-    counts = Counter()
-    with open(file_path, 'r') as file:
-        for line in file:
-            motif = line.strip().upper()
-            if motif in motifs_set:
-                counts[motif] += 1
+    return [''.join(p) for p in itertools.product(nucleotides, repeat=num_nucleotides)]
+
+def motif_index(motif):
+    """Index of a motif in motif_names, None if it is not k bases of ACGT"""
+    codes = BASE_CODES[np.frombuffer(motif.encode(), dtype=np.uint8)]
+    if (codes > 3).any():
+        return None
+    return int(codes.astype(np.int64) @ (4 ** np.arange(len(codes))[::-1]))
+
+def count_lines(buffer, line_starts, line_ends, num_nucleotides, counts):
+    """Add the motifs of the lines buffer[line_starts:line_ends] to the dense 4^k vector counts.
+
+    A line counts when line.strip().upper() is one of the 4^k motifs. Lines of
+    exactly k bytes (after a \r\n ending) are encoded with NumPy; only longer
+    lines that contain whitespace (or non-ASCII bytes) are checked in Python.
+    Shorter lines never count.
+    """
+    line_ends = line_ends - ((line_ends > line_starts) & (buffer[line_ends - 1] == ord('\r')))
+    lengths = line_ends - line_starts
+
+    # one column of the k-mers at a time: index = index * 4 + code
+    exact = line_starts[lengths == num_nucleotides]
+    index = np.zeros(len(exact), dtype=np.int64)
+    valid = np.ones(len(exact), dtype=bool)
+    for offset in range(num_nucleotides):
+        codes = BASE_CODES[buffer[exact + offset]]
+        valid &= codes <= 3
+        index = index * 4 + codes
+    counts += np.bincount(index[valid], minlength=len(counts))
+
+    longer = lengths > num_nucleotides
+    if not longer.any():
+        return
+    special = np.zeros(len(line_starts), dtype=bool)
+    special[np.searchsorted(line_starts, np.flatnonzero(SPECIAL_BYTES[buffer]), side='right') - 1] = True
+    for start, end in zip(line_starts[longer & special].tolist(), line_ends[longer & special].tolist()):
+        # text mode reads a lone \r as a line end
+        for part in buffer[start:end].tobytes().decode().split('\r'):
+            motif = part.strip().upper()
+            if len(motif) == num_nucleotides:
+                index = motif_index(motif)
+                if index is not None:
+                    counts[index] += 1
+
+def count_motif_vector(file_path, num_nucleotides, start=0, stop=None, chunk_size=CHUNK_SIZE, digest=False):
+    """Dense 4^k vector of the motif counts of bytes [start, stop) of one motif file, read in binary chunks.
+
+    With digest=True, returns (counts, range digest) and the bytes are hashed
+    as they are read, so a new file is not read a second time for the cache.
+    """
+    counts = np.zeros(4 ** num_nucleotides, dtype=np.int64)
+    range_digest = hashlib.blake2b(digest_size=16) if digest else None
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        remaining = (os.path.getsize(file_path) if stop is None else stop) - start
+        rest = b''
+        while remaining > 0:
+            data = file.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            if range_digest is not None:
+                range_digest.update(data)
+            buffer = np.frombuffer(rest + data, dtype=np.uint8)
+            newlines = np.flatnonzero(buffer == ord('\n'))
+            if len(newlines) == 0:
+                rest = buffer.tobytes()
+                continue
+            count_lines(buffer, np.concatenate(([0], newlines[:-1] + 1)), newlines, num_nucleotides, counts)
+            rest = buffer[newlines[-1] + 1:].tobytes()
+        if rest:
+            buffer = np.frombuffer(rest, dtype=np.uint8)
+            count_lines(buffer, np.array([0]), np.array([len(buffer)]), num_nucleotides, counts)
+    if range_digest is not None:
+        return counts, range_digest.digest()
     return counts
 
-def count_motifs_in_files(directory_path, num_nucleotides, num_cores):
+def file_ranges(file_path, range_size=RANGE_SIZE):
+    """Split a file into byte ranges of about range_size that start at line boundaries"""
+    size = os.path.getsize(file_path)
+    offsets = [0]
+    with open(file_path, 'rb') as file:
+        for offset in range(range_size, size, range_size):
+            if offset <= offsets[-1]:
+                continue
+            file.seek(offset - 1)
+            file.readline()  # a range starting right after a \n starts at offset itself
+            offsets.append(file.tell())
+    offsets.append(size)
+    offsets = sorted(set(offsets))
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def combine_digests(range_digests):
+    """Content hash of a file from the digests of its file_ranges, in order"""
+    digest = hashlib.blake2b(digest_size=16)
+    for range_digest in range_digests:
+        digest.update(range_digest)
+    return digest.hexdigest()
+
+def file_hash(file_path, range_size=RANGE_SIZE):
+    """Content hash of a motif file, the same as count_motif_vector(digest=True) of its ranges gives"""
+    range_digests = []
+    with open(file_path, 'rb') as file:
+        for start, stop in file_ranges(file_path, range_size):
+            range_digest = hashlib.blake2b(digest_size=16)
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = file.read(min(HASH_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                range_digest.update(data)
+            range_digests.append(range_digest.digest())
+    return combine_digests(range_digests)
+
+def load_cache(cache_file, num_nucleotides):
+    """{file name: (size, mtime, hash, counts)} of a cache file, empty when missing or made for another k"""
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    with np.load(cache_file) as cache:
+        if int(cache['num_nucleotides']) != num_nucleotides:
+            return {}
+        return {name: (int(size), float(mtime), str(digest), counts)
+                for name, size, mtime, digest, counts in zip(cache['names'], cache['sizes'], cache['mtimes'],
+                                                             cache['hashes'], cache['counts'])}
+
+def save_cache(cache_file, num_nucleotides, entries):
+    """Write the cache of the current files, replacing cache_file atomically"""
+    names = list(entries)
+    with open(cache_file + '.tmp', 'wb') as file:
+        np.savez_compressed(file, num_nucleotides=num_nucleotides, names=np.array(names, dtype=str),
+                            sizes=np.array([entries[name][0] for name in names], dtype=np.int64),
+                            mtimes=np.array([entries[name][1] for name in names], dtype=np.float64),
+                            hashes=np.array([entries[name][2] for name in names], dtype=str),
+                            counts=np.array([entries[name][3] for name in names], dtype=np.int64).reshape(len(names), 4 ** num_nucleotides))
+    os.replace(cache_file + '.tmp', cache_file)
+
+def count_motifs_in_files(directory_path, num_nucleotides, num_cores, range_size=RANGE_SIZE, cache_file=None):
+    """Motif x file count matrix of the .txt files in directory_path.
+
+    With a cache_file, files with the size and mtime (or else the content hash)
+    of the cached run reuse their counts, new and changed files are counted, and
+    removed files are dropped from the cache.
+    """
     file_names = [f for f in os.listdir(directory_path) if f.endswith('.txt')]
-    motifs = [''.join(p) for p in itertools.product('ACGT', repeat=num_nucleotides)]
-    motifs_set = set(motifs)
-    motif_df = create_motif_dataframe(num_nucleotides, file_names)
+    file_paths = {file_name: os.path.join(directory_path, file_name) for file_name in file_names}
+    counts = np.zeros((len(file_names), 4 ** num_nucleotides), dtype=np.int64)
+    cache = load_cache(cache_file, num_nucleotides)
+    entries = {}
 
     with ProcessPoolExecutor(max_workers=num_cores) as executor:
-        future_to_file = {executor.submit(process_file, os.path.join(directory_path, file_name), motifs_set): file_name for file_name in file_names}
-        for future in tqdm(as_completed(future_to_file), total=len(file_names), desc="Processing Files"):
-            file_name = future_to_file[future]
-            counts = future.result()
-            for motif, count in counts.items():
-                motif_df.at[motif, file_name] = count
+        # unchanged size and mtime: reuse; otherwise compare the content hash, when there is a cached one
+        stats = {file_name: os.stat(file_paths[file_name]) for file_name in file_names}
+        to_hash = []
+        to_count = set()
+        for file_name in file_names:
+            stat = stats[file_name]
+            cached = cache.get(file_name)
+            if cached is None:
+                to_count.add(file_name)
+            elif cached[:2] == (stat.st_size, stat.st_mtime):
+                entries[file_name] = cached
+            else:
+                to_hash.append(file_name)
+        hashes = dict(zip(to_hash, executor.map(file_hash, [file_paths[file_name] for file_name in to_hash],
+                                                 [range_size] * len(to_hash))))
+        for file_name in to_hash:
+            stat = stats[file_name]
+            if cache[file_name][2] == hashes[file_name]:
+                entries[file_name] = (stat.st_size, stat.st_mtime, hashes[file_name], cache[file_name][3])
+            else:
+                to_count.add(file_name)
+
+        # files without a hash yet are hashed while they are counted, range by range
+        future_to_range = {}
+        range_digests = {}
+        for column, file_name in enumerate(file_names):
+            if file_name not in to_count:
+                continue
+            digest = cache_file is not None and file_name not in hashes
+            ranges = file_ranges(file_paths[file_name], range_size)
+            if digest:
+                range_digests[file_name] = [None] * len(ranges)
+            for index, (start, stop) in enumerate(ranges):
+                future = executor.submit(count_motif_vector, file_paths[file_name], num_nucleotides, start, stop, digest=digest)
+                future_to_range[future] = (column, file_name, index)
+        for future in tqdm(as_completed(future_to_range), total=len(future_to_range), desc="Processing File Ranges"):
+            column, file_name, index = future_to_range[future]
+            if file_name in range_digests:
+                range_counts, range_digests[file_name][index] = future.result()
+            else:
+                range_counts = future.result()
+            counts[column] += range_counts
+    hashes.update({file_name: combine_digests(digests) for file_name, digests in range_digests.items()})
+
+    for column, file_name in enumerate(file_names):
+        if file_name in to_count:
+            if cache_file is not None:
+                stat = stats[file_name]
+                entries[file_name] = (stat.st_size, stat.st_mtime, hashes[file_name], counts[column])
+        else:
+            counts[column] = entries[file_name][3]
+
+    if cache_file is not None:
+        removed = len(set(cache) - set(file_names))
+        print(f"{len(file_names) - len(to_count)} files from the cache, {len(to_count)} counted, {removed} removed")
+        save_cache(cache_file, num_nucleotides, entries)
 
-    return motif_df
+    # one step from the stacked per-file vectors to the motif x file matrix
+    return pd.DataFrame(counts.T, index=motif_names(num_nucleotides), columns=file_names)
 
-# Check if correct number of command line arguments are provided
-if len(sys.argv) != 4:
-    print("Usage: python script.py <directory_of_sample_files> <motif_mar_number> <num_cores>")
-    sys.exit(1)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count motifs in the _motifs.txt files of a folder into <folder>.txt.")
+    parser.add_argument("directory_path", help="Folder of motif files (one motif per line)")
+    parser.add_argument("motif_length", type=int, help="Motif length")
+    parser.add_argument("num_cores", type=int, help="Number of processes")
+    parser.add_argument("--no_cache", action="store_true",
+                        help=f"Recount every file instead of reusing the counts in <folder>.txt{CACHE_SUFFIX}")
+    args = parser.parse_args()
 
-directory_path = sys.argv[1]
-motif_length = int(sys.argv[2])
-num_cores = int(sys.argv[3])
+    directory_path = args.directory_path
+    motif_length = args.motif_length
+    num_cores = args.num_cores
 
-# Start timing the script
-start_time = time.time()
+    # Set the output file name to be the input folder name with a .txt extension
+    output_file = directory_path + '.txt'
+    cache_file = None if args.no_cache else output_file + CACHE_SUFFIX
 
-# Count motifs and create the dataframe
-motif_counts_df = count_motifs_in_files(directory_path, motif_length, num_cores)
+    # Start timing the script
+    start_time = time.time()
 
-# End timing the script
-end_time = time.time()
+    # Count motifs and create the dataframe
+    motif_counts_df = count_motifs_in_files(directory_path, motif_length, num_cores, cache_file=cache_file)
 
-# Set the output file name to be the input folder name with a .txt extension
-output_file = directory_path + '.txt'
+    # End timing the script
+    end_time = time.time()
 
-# Save the dataframe to the output file
-motif_counts_df.to_csv(output_file, sep='\t')
+    # Save the dataframe to the output file
+    motif_counts_df.to_csv(output_file, sep='\t')
 
-# Print out the time taken
-print(f"Processed in {end_time - start_time:.2f} seconds.")
+    # Print out the time taken
+    print(f"Processed in {end_time - start_time:.2f} seconds.")
 
-# Inform the user where the motif counts were saved
-print(f"Motif counts saved to {output_file}")
+    # Inform the user where the motif counts were saved
+    print(f"Motif counts saved to {output_file}")
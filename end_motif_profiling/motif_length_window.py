@@ -0,0 +1,38 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from bam_motif_counter import motif_names, length_window
+
+def length_window_matrix(profile_dir, min_length, max_length, num_nucleotides):
+    """Motif x sample matrix of fragments with min_length <= |TLEN| <= max_length, from the
+    --length_profile folder of bam_motif_counter.py"""
+    profile_files = sorted(name for name in os.listdir(profile_dir) if name.endswith('.npz'))
+    columns = [name[:-len('.npz')] + '_motifs.txt' for name in profile_files]
+    counts = np.zeros((len(profile_files), 4 ** num_nucleotides), dtype=np.int64)
+    for row, name in enumerate(profile_files):
+        with np.load(os.path.join(profile_dir, name)) as profile:
+            if f"k{num_nucleotides}" not in profile:
+                raise ValueError(f"{name} has no profile of {num_nucleotides}-nucleotide motifs")
+            counts[row] = length_window(profile[f"k{num_nucleotides}"], min_length, max_length)
+    return pd.DataFrame(counts.T, index=motif_names(num_nucleotides), columns=columns)
+
+def main():
+    parser = argparse.ArgumentParser(description="Slice a fragment length window out of the length x motif profiles of bam_motif_counter.py, instead of filtering BAMs with filter_bam_by_length.sh.")
+    parser.add_argument("profile_dir", help="--length_profile folder of bam_motif_counter.py")
+    parser.add_argument("min_length", type=int, help="Shortest fragment length (|TLEN|) kept")
+    parser.add_argument("max_length", type=int, help="Longest fragment length (|TLEN|) kept")
+    parser.add_argument("n_motif", type=int, help="Motif length, one of those counted by bam_motif_counter.py")
+    parser.add_argument("--output_file", default=None,
+                        help="Motif count matrix, default <profile_dir>_filtered_<min_length>_<max_length>_motifs_<n_motif>.txt")
+    args = parser.parse_args()
+
+    output_file = args.output_file or \
+        f"{args.profile_dir.rstrip('/')}_filtered_{args.min_length}_{args.max_length}_motifs_{args.n_motif}.txt"
+    motif_counts_df = length_window_matrix(args.profile_dir, args.min_length, args.max_length, args.n_motif)
+    motif_counts_df.to_csv(output_file, sep='\t')
+    print(f"Motif counts saved to {output_file}")
+
+if __name__ == "__main__":
+    main()
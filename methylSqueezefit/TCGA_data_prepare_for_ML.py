@@ -19,11 +19,19 @@ if data_folder_path.endswith('/'):
 else:
     output_file_path = f"{data_folder_path}_Allmatrix"
 
+# the filtered blocks of one sample; filter_cpg_std.py --columnar writes them as a table next to the text as well,
+# which is read instead of parsing the text unless the text was written after it
+def read_sample(file_path):
+    for suffix, read_table in [('.parquet', pd.read_parquet), ('.arrow', pd.read_feather)]:
+        if os.path.exists(file_path + suffix) and os.path.getmtime(file_path + suffix) >= os.path.getmtime(file_path):
+            return read_table(file_path + suffix)
+    return pd.read_csv(file_path, sep='\t', header=None, names=['chrom', 'start', 'end', 'value'])
+
 for file_name in tqdm(os.listdir(data_folder_path), desc='Processing files'):
     if file_name.endswith('.bedgraph'):
         file_path = os.path.join(data_folder_path, file_name)
         try:
-            df = pd.read_csv(file_path, sep='\t', header=None, names=['chrom', 'start', 'end', 'value'])
+            df = read_sample(file_path)
             df['feature'] = df['chrom'].astype(str) + ':' + df['start'].astype(str) + '-' + df['end'].astype(str)
             sample_name = file_name.rsplit('.', 1)[0]
 